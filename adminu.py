@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2013
+#    Francisco Dos Santos <f.dos.santos@free.fr>
+
+"""
+Compact storage of administrative areas and their hierarchy.
+"""
+
+import array
+from itertools import chain, groupby
+
+
+class AdminUtil:
+    """
+    Manage administrative areas (distrito/region, municipio, freguesia).
+
+    Each area get an integer id in creation order, attributes are stored
+    by column and lines of an area are kept in sorted arrays.
+    """
+
+    def __init__(self):
+        self.admin_id = {}                    # DICOFRE -> admin id
+        self.admin_code = []                  # (admin id) -> DICOFRE
+        self.admin_name = []                  # (admin id) -> name
+        self.admin_level = array.array('b')   # (admin id) -> admin level
+        self.admin_parent = array.array('i')  # (admin id) -> parent id or -1
+        self.admin_outer = []                 # (admin id) -> outer line ids
+        self.admin_inner = []                 # (admin id) -> inner line ids
+        self.admin_features = []              # (admin id) -> lines by feature
+        self.bbox_xmin = array.array('d')     # (admin id) -> bounding box
+        self.bbox_xmax = array.array('d')
+        self.bbox_ymin = array.array('d')
+        self.bbox_ymax = array.array('d')
+
+
+    def addAdmin(self, code, name, level, parentcode=None):
+        """
+        Create an administrative area, return its id.
+        """
+
+        adminid = len(self.admin_code)
+        self.admin_id[code] = adminid
+        self.admin_code.append(code)
+        self.admin_name.append(name)
+        self.admin_level.append(level)
+        if parentcode is None:
+            self.admin_parent.append(-1)
+        else:
+            self.admin_parent.append(self.admin_id[parentcode])
+        self.admin_outer.append(array.array('i'))
+        self.admin_inner.append(array.array('i'))
+        self.admin_features.append([])
+        for column in (self.bbox_xmin, self.bbox_xmax,
+                       self.bbox_ymin, self.bbox_ymax):
+            column.append(0.0)
+        return adminid
+
+
+    def getAdmin(self, code):
+        """
+        Return id of the administrative area with DICOFRE 'code' or None.
+        """
+
+        return self.admin_id.get(code)
+
+
+    def nbrAdmins(self):
+        """
+        Return number of administrative areas.
+        """
+
+        return len(self.admin_code)
+
+
+    def iterAdmins(self):
+        """
+        Iterate on each administrative area id (creation order).
+        """
+
+        return iter(xrange(len(self.admin_code)))
+
+
+    def getCode(self, adminid):
+        return self.admin_code[adminid]
+
+
+    def getName(self, adminid):
+        return self.admin_name[adminid]
+
+
+    def getLevel(self, adminid):
+        return self.admin_level[adminid]
+
+
+    def getParent(self, adminid):
+        """
+        Return id of the parent area or None for a top level area.
+        """
+
+        parentid = self.admin_parent[adminid]
+        if parentid < 0:
+            return None
+        return parentid
+
+
+    def addFeature(self, adminid, lineids):
+        """
+        Add lines of a polygon read from the shapefile to an area.
+
+        The area gets all the lines, its upper areas only get lines not
+        shared by an even number of polygons (see buildHierarchy).
+        """
+
+        lineids = array.array('i', sorted(lineids))
+        self.admin_features[adminid].append(lineids)
+        self.admin_outer[adminid] = array.array('i',
+                      sorted(set(self.admin_outer[adminid]).union(lineids)))
+
+
+    def clearFeatures(self, adminid):
+        """
+        Forget lines of an area added by addFeature.
+        """
+
+        self.admin_features[adminid] = []
+        self.admin_outer[adminid] = array.array('i')
+        self.admin_inner[adminid] = array.array('i')
+
+
+    def buildHierarchy(self, adminids=None):
+        """
+        Compute lines of each upper area from its polygons, or only of
+        the upper areas in 'adminids'.
+
+        A line shared by two polygons is removed (symmetric difference
+        of all polygons).
+        """
+
+        features = [ [] for adminid in self.iterAdmins() ]
+        for adminid in self.iterAdmins():
+            parentid = self.admin_parent[adminid]
+            while parentid >= 0:
+                features[parentid].extend(self.admin_features[adminid])
+                parentid = self.admin_parent[parentid]
+        if adminids is None:
+            adminids = self.iterAdmins()
+        for adminid in adminids:
+            if features[adminid]:
+                self.admin_outer[adminid] = xorlines(features[adminid])
+                self.admin_inner[adminid] = array.array('i')
+
+
+    def getLines(self, adminid, role="outer"):
+        """
+        Return sorted array of lines id for role 'outer' or 'inner'.
+        """
+
+        if role == "outer":
+            return self.admin_outer[adminid]
+        return self.admin_inner[adminid]
+
+
+    def setLines(self, adminid, outer, inner):
+        """
+        Replace lines of an area.
+        """
+
+        self.admin_outer[adminid] = array.array('i', sorted(outer))
+        self.admin_inner[adminid] = array.array('i', sorted(inner))
+
+
+    def setExtent(self, adminid, bbox):
+        """
+        Set bounding box (xmin, xmax, ymin, ymax) of an area.
+        """
+
+        (self.bbox_xmin[adminid], self.bbox_xmax[adminid],
+         self.bbox_ymin[adminid], self.bbox_ymax[adminid]) = bbox
+
+
+    def getExtent(self, adminid):
+        """
+        Return bounding box (xmin, xmax, ymin, ymax) of an area.
+        """
+
+        return (self.bbox_xmin[adminid], self.bbox_xmax[adminid],
+                self.bbox_ymin[adminid], self.bbox_ymax[adminid])
+
+
+def xorlines(arrays):
+    """
+    Return sorted array of lines present an odd number of times.
+    """
+
+    lineids = sorted(chain(*arrays))
+    return array.array('i', [ lineid for lineid, group in groupby(lineids)
+                                     if len(list(group)) & 1 ])
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2013
+#    Francisco Dos Santos <f.dos.santos@free.fr>
+
+"""
+Compare COPY in text and binary format (see caop_config.copybinary).
+
+Start with the same shapefiles as caop_build, the time to format all
+caop tables is given for each format, then the time to load them into
+temporary tables of the database (nothing is kept, areas are not
+verified).
+"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import psycopg2
+from shapeu import ShapeUtil
+from adminu import AdminUtil
+import caop_build
+import logo
+import caop_config
+
+
+def format_tables(shapeu, admins, workdir, binary):
+    """
+    Write all tables in 'workdir', return elapsed time and total size.
+    """
+
+    files = {}
+    for table, columns, types in caop_build.copytables:
+        files[table] = open(os.path.join(workdir, table), "wb")
+    start = time.time()
+    caop_build.export_caop(shapeu, admins, -1, files, binary)
+    for output in files.itervalues():
+        output.close()
+    elapsed = time.time() - start
+    size = sum([ os.path.getsize(os.path.join(workdir, table))
+                 for table, columns, types in caop_build.copytables ])
+    return elapsed, size
+
+
+def load_tables(db, workdir, binary):
+    """
+    Load files of 'workdir' into temporary copies of caop tables,
+    return elapsed time.
+    """
+
+    cursor = db.cursor()
+    # Temporary tables hide the final tables with the same name
+    for table, columns, types in caop_build.copytables:
+        cursor.execute("""CREATE TEMPORARY TABLE %s (LIKE %s)
+                          ON COMMIT DROP""" % (table, table))
+    start = time.time()
+    for table, columns, types in caop_build.copytables:
+        with open(os.path.join(workdir, table), "rb") as f:
+            caop_build.copy_file(cursor, table, f, binary)
+    elapsed = time.time() - start
+    db.rollback()
+    return elapsed
+
+
+def main():
+    logo.init(filename = caop_config.logfile,
+              verbose = caop_config.verbose,
+              progress = caop_config.progress)
+    if len(sys.argv) < 2:
+        raise logo.ERROR("Missing input Shapefile")
+
+    shapeu = ShapeUtil(caop_config.cachesize)
+    for i in xrange(1, len(sys.argv)):
+        logo.INFO("Reading geometries '%s'" % sys.argv[i])
+        caop_build.read_CAOP(sys.argv[i], shapeu)
+    shapeu.buildSimplifiedLines()
+    admins = AdminUtil()
+    for i in xrange(1, len(sys.argv)):
+        caop_build.admin_CAOP(sys.argv[i], shapeu, admins)
+    logo.INFO("%d nodes, %d ways, %d relations" % (
+              shapeu.nbrPoints(), shapeu.nbrLines(), admins.nbrAdmins()))
+
+    try:
+        db = psycopg2.connect(caop_config.dbname)
+    except psycopg2.Error, e:
+        logo.WARN("No database, only formatting is measured (%s)" % e)
+        db = None
+
+    workdir = tempfile.mkdtemp(prefix="caop")
+    try:
+        for name, binary in (("text", False), ("binary", True)):
+            elapsed, size = format_tables(shapeu, admins, workdir, binary)
+            logo.INFO("%-6s format %7.2fs %10d bytes" % (name, elapsed, size))
+            if db is not None:
+                elapsed = load_tables(db, workdir, binary)
+                logo.INFO("%-6s load   %7.2fs" % (name, elapsed))
+    finally:
+        shutil.rmtree(workdir)
+    logo.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,12 +22,24 @@
 #    Francisco Dos Santos <f.dos.santos@free.fr>
 
 import sys
+import array
+import itertools
 import re
+import struct
+import multiprocessing
+import threading
+import Queue
+import os
+import shutil
+import tempfile
+import traceback
 import psycopg2
-from cStringIO import StringIO
 from osgeo import gdal, ogr, osr
 from shapeu import ShapeUtil
-from ringue import FindClosedRings
+from adminu import AdminUtil
+from lookupu import writeLookupIndex
+from ringue import FindClosedRings, FindPlanarRings, RingCache, LineCache
+from ringue import LineChains, ChainRingCache
 import logo
 import caop_config
 
@@ -191,162 +203,478 @@ def admin_CAOP(filename, shapeu, admins):
         # Distrito or Region
         if isregion:
             dicofre1  = dicofre[0:1]
-            if not admins.has_key(dicofre1):
+            if admins.getAdmin(dicofre1) is None:
                 # Extract archipelago name from island name
                 m = re.search("\(([^)]+)\)", distrito)
                 if m:
                     distrito = m.group(1)
-                admins[dicofre1] = { "name" : distrito,
-                                     "level" : 4,
-                                     "inner" : set(),
-                                     "outer" : set(),
-                                     "bbox" : None
-                                   }
+                admins.addAdmin(dicofre1, distrito, 4)
         else:
             dicofre1  = dicofre[0:2]
-            if not admins.has_key(dicofre1):
-                admins[dicofre1] = { "name" : distrito,
-                                     "level" : 6,
-                                     "inner" : set(),
-                                     "outer" : set(),
-                                     "bbox" : None
-                                   }
+            if admins.getAdmin(dicofre1) is None:
+                admins.addAdmin(dicofre1, distrito, 6)
 
         # Municipio
         dicofre2  = dicofre[0:4]
-        if not admins.has_key(dicofre2):
-            admins[dicofre2] = { "name" : municipio,
-                                 "level" : 7,
-                                 "inner" : set(),
-                                 "outer" : set(),
-                                 "bbox" : None
-                               }
+        if admins.getAdmin(dicofre2) is None:
+            admins.addAdmin(dicofre2, municipio, 7, dicofre1)
 
         # Freguesia
-        if not admins.has_key(dicofre):
-            admins[dicofre]  = { "name" : freguesia,
-                                 "level" : 8,
-                                 "inner" : set(),
-                                 "outer" : set(),
-                                 "bbox" : None
-                               }
-
-        # Build sets of lineid, don't distinguish outer and inner rings
-        # we deal it later when verifying and grouping rings
-        lineset = set()
-        for i in xrange(newgeometry.GetGeometryCount()):
-            ring = newgeometry.GetGeometryRef(i)
-            pntinring = []
-            for pnt in xrange(ring.GetPointCount()):
-                lon, lat = ring.GetPoint_2D(pnt)
-                pointid = shapeu.getPoint(lon, lat)
-                if pointid is not None:
-                    pntinring.append(pointid)
-
-            if pntinring[0] != pntinring[-1]:
-                # Simplification have broken the ring,
-                # starting point was in the middle of a simplified line
-                pntinring.append(pntinring[0])
-
-            for pnt in xrange(1, len(pntinring)):
-                if pntinring[pnt-1] ==  pntinring[pnt]:
-                    # If 2 coordinates after rounding give the same point id
-                    # (safety measure, normaly doesn't happen)
-                    continue
-                segment = shapeu.getSegment(pntinring[pnt-1], pntinring[pnt])
-                lineset.add(shapeu.getLine(segment))
-
-        # Update each administrative level
-        admins[dicofre]["outer"].update(lineset)
-        admins[dicofre2]["outer"].symmetric_difference_update(lineset)
-        admins[dicofre1]["outer"].symmetric_difference_update(lineset)
+        if admins.getAdmin(dicofre) is None:
+            admins.addAdmin(dicofre, freguesia, 8, dicofre2)
+
+        # Update freguesia, upper levels are built at the end
+        lineset = feature_lines(newgeometry, shapeu)
+        if lineset is None:
+            raise logo.ERROR("Polygon of '%s' is not made of known segments"
+                             % dicofre)
+        admins.addFeature(admins.getAdmin(dicofre), lineset)
     logo.ending()
 
+    # Municipio and distrito/region lines are the symmetric difference
+    # of their polygons
+    admins.buildHierarchy()
 
-def verify_admin(shapeu, admins):
+
+def reload_admin(filenames, shapeu, admins, dicofre):
     """
-    Check that all administrative area are closed.
+    Reread polygons of a freguesia from the shapefiles.
 
-    Also search for inner ring and update 'admins'.
+    Lines of the freguesia and of its upper areas are updated, the points
+    must already exist (a new geometry needs a full rebuild, ValueError).
+    Return list of admin id updated (freguesia first) or None.
     """
 
-    logo.starting("Verify admin area", len(admins))
-    verifyinner = {}
-    for dicofre in admins:
-        logo.progress()
-        logo.DEBUG("Area level=%(level)d '%(name)s'" % admins[dicofre])
-
-        # Administrative areas read from the shapefile are also checked
-        # and dispatched into outer/inner ring, even if technically only
-        # the upper and reconstructed admin level need it (the shapefile
-        # already knows what's outer and inner, but we avoid a special
-        # case and it cannot fail unless something was really wrong).
-        closedrings = FindClosedRings(shapeu, admins[dicofre]["outer"])
+    adminid = admins.getAdmin(dicofre)
+    if adminid is None or admins.getLevel(adminid) != 8:
+        return None
+
+    # Nothing is changed until all polygons are mapped on existing lines
+    linesets = []
+    for filename in filenames:
+        shapefile = ogr.Open(filename)
+        layer = shapefile.GetLayer(0)
+        srcSpatialRef = layer.GetSpatialRef()
+        dstSpatialRef = osr.SpatialReference()
+        dstSpatialRef.SetWellKnownGeogCS('WGS84')
+        transform = osr.CoordinateTransformation(srcSpatialRef, dstSpatialRef)
+        layer.SetAttributeFilter("DICOFRE = '%s'" % dicofre)
+        for feature in layer:
+            newgeometry = feature.GetGeometryRef().Clone()
+            newgeometry.Transform(transform)
+            lineset = feature_lines(newgeometry, shapeu)
+            if lineset is None:
+                raise ValueError("'%s' has a new geometry, a full rebuild"
+                                 " is needed" % dicofre)
+            linesets.append(lineset)
+
+    updated = []
+    parentid = adminid
+    while parentid is not None:
+        updated.append(parentid)
+        parentid = admins.getParent(parentid)
+
+    admins.clearFeatures(adminid)
+    for lineset in linesets:
+        admins.addFeature(adminid, lineset)
+    admins.buildHierarchy(updated[1:])
+    return updated
+
+
+def feature_lines(geometry, shapeu):
+    """
+    Return set of lineid used by a polygon geometry, None if a segment
+    doesn't exist in shapeu.
+    """
+
+    # Build sets of lineid, don't distinguish outer and inner rings
+    # we deal it later when verifying and grouping rings
+    lineset = set()
+    for i in xrange(geometry.GetGeometryCount()):
+        ring = geometry.GetGeometryRef(i)
+        pntinring = []
+        for pnt in xrange(ring.GetPointCount()):
+            lon, lat = ring.GetPoint_2D(pnt)
+            pointid = shapeu.getPoint(lon, lat)
+            if pointid is not None:
+                pntinring.append(pointid)
+
+        if pntinring[0] != pntinring[-1]:
+            # Simplification have broken the ring,
+            # starting point was in the middle of a simplified line
+            pntinring.append(pntinring[0])
+
+        for pnt in xrange(1, len(pntinring)):
+            if pntinring[pnt-1] ==  pntinring[pnt]:
+                # If 2 coordinates after rounding give the same point id
+                # (safety measure, normaly doesn't happen)
+                continue
+            segment = shapeu.getSegment(pntinring[pnt-1], pntinring[pnt])
+            if segment is None:
+                return None
+            lineset.add(shapeu.getLine(segment))
+    return lineset
+
+
+# Verification state, also set in each worker process of the pool (fork
+# copy-on-write of ShapeUtil arrays), see verify_pool
+verifystate = {}
+
+
+def verify_rings(lines, childrings=None):
+    """
+    Assemble rings of an area, return a summary of the result.
+
+    With the rings of its children areas ('childrings', lists of lines)
+    only the chains of lines left from these rings are assembled (see
+    LineChains), the lines are assembled one by one if it fails.
+
+    Can run in a worker process, the summary is a tuple :
+    - True if area is valid
+    - counters of the assembly
+    - list of crossing rings (nbr lines ring1, nbr lines ring2, point)
+    - list of other discarded rings (nbr lines, None if closed or
+      first and last point if open)
+    - list of lines for each inner ring
+    - list of lines for each ring
+    """
+
+    ringcache = verifystate["ringcache"]
+    linecache = verifystate["linecache"]
+    hits, misses = ringcache.hits, ringcache.misses
+    linehits, linemisses = linecache.hits, linecache.misses
+    counters = dict.fromkeys( ('backtracks', 'validchecks', 'geometries',
+                               'elapsed'), 0 )
+    closedrings = None
+    if childrings:
+        chains = LineChains(verifystate["shapeu"], lines, childrings,
+                            linecache)
+        closedrings = verifystate["findrings"](chains, chains.getChains(),
+                                    ChainRingCache(chains, ringcache),
+                                    checkgrowing=False,
+                                    maxbacktrack=caop_config.ringbacktrack,
+                                    maxtime=caop_config.ringtimeout)
+        getlines = chains.getLines
         if not closedrings.isValid():
-            logo.ERROR("Area '%s' (DICOFRE=%s) not a valid closed ring\n"
-                       % (admins[dicofre]["name"], dicofre) )
-            for ring, pntid1, pntid2 in closedrings.iterRingDiscarded():
-                lineids = closedrings.getLineDiscarded(ring)
-                if pntid1 == pntid2:
-                    logo.WARN("Ring with %d lines is self-intersecting, still building admin area with this defect"
-                              % len(lineids))
-                else:
-                    points = closedrings.getGeometryDiscarded(ring)
-                    logo.WARN("Ring with %d lines is open at %s -> %s, still building admin area with this defect"
-                               % (len(lineids), points[0], points[-1]))
-            xmin, xmax, ymin, ymax = closedrings.getExtentLineDiscarded()
-            admins[dicofre]["bbox"] = [ xmin, xmax, ymin, ymax ]
-
-        # Moving lineids from outer to inner and compute envelope
-        for outer, inner in closedrings.iterPolygons():
-            for ring in inner:
-                lineids = closedrings.getLineRing(ring)
-                admins[dicofre]["outer"].difference_update(lineids)
-                admins[dicofre]["inner"].update(lineids)
-                for line in lineids:
-                    # Remember lines used in inner ring for later verification
-                    key = (line, admins[dicofre]["level"])
-                    verifyinner[key] = [dicofre]
-
-            # Bounding box on outer rings
-            xmin, xmax, ymin, ymax = closedrings.getExtentRing(outer)
-            if not admins[dicofre]["bbox"]:
-                admins[dicofre]["bbox"] = [ xmin, xmax, ymin, ymax ]
+            # Defects are reported on lines
+            stats = closedrings.stats()
+            for key in counters:
+                counters[key] += stats[key]
+            closedrings = None
+    if closedrings is None:
+        closedrings = verifystate["findrings"](verifystate["shapeu"], lines,
+                                    ringcache, linecache, checkgrowing=True,
+                                    maxbacktrack=caop_config.ringbacktrack,
+                                    maxtime=caop_config.ringtimeout)
+        getlines = list
+    stats = closedrings.stats()
+    for key in counters:
+        stats[key] += counters[key]
+    stats['cachehits'] = ringcache.hits - hits
+    stats['cachemisses'] = ringcache.misses - misses
+    stats['linehits'] = linecache.hits - linehits
+    stats['linemisses'] = linecache.misses - linemisses
+
+    crossing = []
+    crossrings = set()
+    for ring1, ring2, coord in closedrings.iterRingCrossing():
+        crossing.append( (len(closedrings.getLineDiscarded(ring1)),
+                          len(closedrings.getLineDiscarded(ring2)), coord) )
+        crossrings.update( (ring1, ring2) )
+    discarded = []
+    for ring, pntid1, pntid2 in closedrings.iterRingDiscarded():
+        if ring in crossrings:
+            continue
+        lineids = closedrings.getLineDiscarded(ring)
+        if pntid1 == pntid2:
+            discarded.append( (len(lineids), None) )
+        else:
+            points = closedrings.getGeometryDiscarded(ring)
+            discarded.append( (len(lineids), (points[0], points[-1])) )
+
+    innerrings = [ getlines(closedrings.getLineRing(ring))
+                   for outer, inner in closedrings.iterPolygons()
+                   for ring in inner ]
+    rings = [ getlines(closedrings.getLineRing(ring))
+              for ring in xrange(closedrings.nbrRing()) ]
+    return (closedrings.isValid(), stats, crossing, discarded, innerrings,
+            rings)
+
+
+def verify_task(task):
+    """
+    Run verify_rings for an area (possibly in a worker process), 'task'
+    is (lines, validity of rings already checked at lower levels, rings
+    of its children areas).
+
+    Return (summary of verify_rings, validity of rings checked for the
+    area) as list of (lines, valid).
+    """
+
+    lines, known, childrings = task
+    ringcache = verifystate["ringcache"]
+    ringcache.update(known)
+    result = verify_rings(lines, childrings)
+    return result, ringcache.getAdded()
+
+
+def init_verify(shapeu):
+    """
+    Prepare verification state for verify_rings.
+    """
+
+    if caop_config.planarrings:
+        findrings = FindPlanarRings
+    else:
+        findrings = FindClosedRings
+    verifystate["shapeu"] = shapeu
+    verifystate["findrings"] = findrings
+    verifystate["ringcache"] = RingCache()          # validity of each ring
+    verifystate["linecache"] = LineCache(shapeu)    # coordinates of lines
+
+
+def init_worker(shapeu):
+    """
+    Initialize a worker process of the verification pool.
+    """
+
+    # Messages of the workers would be mixed with those of the main
+    # process in the log file
+    logo.silence()
+    init_verify(shapeu)
+
+
+def verify_pool(shapeu):
+    """
+    Start the processes used by verify_admin, None if the areas are
+    verified in the main process (caop_config.processes = 1).
+
+    The caller must terminate the pool.
+    """
+
+    if caop_config.processes == 1:
+        return None
+    logo.flush()
+    return multiprocessing.Pool(caop_config.processes, init_worker,
+                                (shapeu,))
+
+
+def update_area(shapeu, admins, adminid, result):
+    """
+    Log defects and dispatch lines of an area into outer/inner ring from
+    the result of verify_rings.
+
+    Return set of inner lines.
+    """
+
+    dicofre = admins.getCode(adminid)
+    name = admins.getName(adminid)
+    level = admins.getLevel(adminid)
+    logo.DEBUG("Area level=%d '%s'" % (level, name))
+    valid, stats, crossing, discarded, innerrings, rings = result
+    if stats['overbudget']:
+        logo.WARN("Area '%s' (DICOFRE=%s) search of rings stopped after %d backtracks (%.1fs)"
+                  % (name, dicofre, stats['backtracks'], stats['elapsed']))
+    if not valid:
+        logo.ERROR("Area '%s' (DICOFRE=%s) not a valid closed ring\n"
+                   % (name, dicofre) )
+        for nbrlines1, nbrlines2, coord in crossing:
+            logo.WARN("Rings with %d and %d lines are crossing at %s, still building admin area with this defect"
+                      % (nbrlines1, nbrlines2, coord))
+        for nbrlines, ends in discarded:
+            if ends is None:
+                logo.WARN("Ring with %d lines is self-intersecting, still building admin area with this defect"
+                          % nbrlines)
             else:
-                if xmin < admins[dicofre]["bbox"][0]:
-                    admins[dicofre]["bbox"][0] = xmin
-                if xmax > admins[dicofre]["bbox"][1]:
-                    admins[dicofre]["bbox"][1] = xmax
-                if ymin < admins[dicofre]["bbox"][2]:
-                    admins[dicofre]["bbox"][2] = ymin
-                if ymax > admins[dicofre]["bbox"][3]:
-                    admins[dicofre]["bbox"][3] = ymax
+                logo.WARN("Ring with %d lines is open at %s -> %s, still building admin area with this defect"
+                           % (nbrlines, ends[0], ends[1]))
+
+    # Bounding box of area from precomputed line extents (inner rings
+    # are inside outer rings and discarded lines are also included)
+    outer = admins.getLines(adminid, "outer")
+    bbox = shapeu.getExtentLines(outer)
+    if bbox is None:
+        # No line at all, same empty bounding box as a new area
+        bbox = (0.0, 0.0, 0.0, 0.0)
+    admins.setExtent(adminid, bbox)
+
+    # Moving lineids from outer to inner
+    inner = set()
+    for lineids in innerrings:
+        inner.update(lineids)
+    admins.setLines(adminid, [ line for line in outer
+                               if line not in inner ], inner)
+    return inner
+
+
+def verify_area(shapeu, admins, adminid):
+    """
+    Check again one administrative area (see verify_admin).
 
+    Return the result of verify_rings.
+    """
+
+    lines = set(admins.getLines(adminid, "outer"))
+    lines.update(admins.getLines(adminid, "inner"))
+    admins.setLines(adminid, lines, [])
+    result, added = verify_task( (frozenset(lines), [], None) )
+    update_area(shapeu, admins, adminid, result)
+    return result
+
+
+def verify_admin(shapeu, admins, pool=None):
+    """
+    Check that all administrative area are closed.
+
+    Also search for inner ring and update 'admins'.
+    The 'pool' of processes is created if not given (see verify_pool).
+    """
+
+    init_verify(shapeu)
+
+    # Administrative areas read from the shapefile are also checked
+    # and dispatched into outer/inner ring, even if technically only
+    # the upper and reconstructed admin level need it (the shapefile
+    # already knows what's outer and inner, but we avoid a special
+    # case and it cannot fail unless something was really wrong).
+    # An area with the exact same lines as another area (i.e. municipio
+    # with only 1 freguesia) is verified only once.
+    areakeys = {}
+    depths = {}
+    for adminid in admins.iterAdmins():
+        areakey = frozenset(admins.getLines(adminid, "outer"))
+        areakeys[adminid] = areakey
+        depth = 0
+        parentid = admins.getParent(adminid)
+        while parentid is not None:
+            depth += 1
+            parentid = admins.getParent(parentid)
+        depths[areakey] = max(depths.get(areakey, 0), depth)
+    children = dict([ (areakey, set()) for areakey in depths ])
+    for adminid in admins.iterAdmins():
+        parentid = admins.getParent(adminid)
+        if parentid is not None and areakeys[parentid] != areakeys[adminid]:
+            children[areakeys[parentid]].add(areakeys[adminid])
+
+    # Areas are verified level by level (freguesias first), the rings
+    # of an area already checked at lower levels are given with the area
+    # to the process verifying it (see caop_config.processes), an upper
+    # area is assembled from the rings of its children (see verify_rings)
+    logo.starting("Verify admin area", len(depths))
+    results = {}
+    checked = {}            # Line ID -> rings checked with this line
+    ownpool = pool is None
+    if ownpool:
+        pool = verify_pool(shapeu)
+    try:
+        for depth in sorted(set(depths.itervalues()), reverse=True):
+            # Biggest areas first (distritos, islands), so that they are
+            # not the last ones running when using several processes
+            tasks = sorted([ areakey for areakey in depths
+                             if depths[areakey] == depth ],
+                           key=len, reverse=True)
+            known = []
+            for areakey in tasks:
+                rings = {}
+                for lineid in areakey:
+                    for lines, valid in checked.get(lineid, ()):
+                        if lines not in rings and lines <= areakey:
+                            rings[lines] = valid
+                known.append(rings.items())
+            childrings = [ [ ring for childkey in sorted(children[areakey],
+                                                         key=sorted)
+                                  if childkey in results
+                                  for ring in results[childkey][5] ]
+                           for areakey in tasks ]
+            args = zip(tasks, known, childrings)
+            if pool is None:
+                verified = itertools.imap(verify_task, args)
+            else:
+                verified = pool.imap(verify_task, args, 1)
+            added = []
+            for areakey, (result, rings) in itertools.izip(tasks, verified):
+                logo.progress()
+                results[areakey] = result
+                added.extend(rings)
+            for lines, valid in added:
+                for lineid in lines:
+                    checked.setdefault(lineid, []).append( (lines, valid) )
+    finally:
+        if ownpool and pool is not None:
+            pool.terminate()
     logo.ending()
 
+    # Merge results in admins order
+    counters = dict.fromkeys( ('backtracks', 'validchecks', 'geometries',
+                               'elapsed', 'cachehits', 'cachemisses',
+                               'linehits', 'linemisses'), 0 )
+    for stats in [ result[1] for result in results.itervalues() ]:
+        for key in counters:
+            counters[key] += stats[key]
+    for adminid in admins.iterAdmins():
+        update_area(shapeu, admins, adminid, results[areakeys[adminid]])
+
+    nbrcheck = counters['cachehits'] + counters['cachemisses']
+    logo.INFO("Area reused %d/%d, ring validity cache %d hits, %d misses (%.1f%%)"
+              % (admins.nbrAdmins() - len(depths), admins.nbrAdmins(),
+                 counters['cachehits'],
+                 counters['cachemisses'],
+                 nbrcheck and 100.0 * counters['cachehits'] / nbrcheck))
+    nbrcheck = counters['linehits'] + counters['linemisses']
+    logo.DEBUG("Line coordinates cache %d hits, %d misses (%.1f%%)"
+               % (counters['linehits'], counters['linemisses'],
+                  nbrcheck and 100.0 * counters['linehits'] / nbrcheck))
+    logo.DEBUG("Rings search %(backtracks)d backtracks, %(validchecks)d validity checks, %(geometries)d geometries in %(elapsed).1fs"
+               % counters)
+
+    verify_inner(admins, list(admins.iterAdmins()))
+
+
+def verify_inner(admins, adminids):
+    """
+    Check the inner lines of the areas 'adminids' (once verified).
+
+    Return number of inner lines in error.
+    """
+
+    verifyinner = {}
+    levels = set()
+    for adminid in adminids:
+        level = admins.getLevel(adminid)
+        levels.add(level)
+        for line in admins.getLines(adminid, "inner"):
+            verifyinner[(line, level)] = [adminid]
+
     # Each inner line on each admin level should be used as outer line
     # in one and only one admin area with the same level
-    for dicofre in admins:
-        for line in admins[dicofre]["outer"]:
-            key = (line, admins[dicofre]["level"])
+    for adminid in admins.iterAdmins():
+        level = admins.getLevel(adminid)
+        if level not in levels:
+            continue
+        for line in admins.getLines(adminid, "outer"):
+            key = (line, level)
             if key in verifyinner:
-                verifyinner[key].append(dicofre)
+                verifyinner[key].append(adminid)
+    nbrerror = 0
     for key in verifyinner:
         if len(verifyinner[key]) != 2:
-            dicofre = verifyinner[key][0]
+            nbrerror += 1
+            adminid = verifyinner[key][0]
             if len(verifyinner[key]) == 1:
                 logo.ERROR("Inner line in area '%s' (DICOFRE=%s) not present as outer in any admin area with level=%d\n"
-                           % (admins[dicofre]["name"], dicofre,
-                              admins[dicofre]["level"])
+                           % (admins.getName(adminid), admins.getCode(adminid),
+                              admins.getLevel(adminid))
                           )
             else:
                 logo.ERROR("Inner line in area '%s' (DICOFRE=%s) exist as multiple outer in level=%d : %s\n"
-                           % (admins[dicofre]["name"], dicofre,
-                              admins[dicofre]["level"],
+                           % (admins.getName(adminid), admins.getCode(adminid),
+                              admins.getLevel(adminid),
                               ', '.join([ "%s (DICOFRE=%s)" % (
-                                             admins[i]["name"], i)
+                                             admins.getName(i),
+                                             admins.getCode(i))
                                           for i in verifyinner[key][1:] ]))
                           )
+    return nbrerror
 
 
 def create_caop_table(db):
@@ -475,58 +803,372 @@ def create_caop_table(db):
     db.commit()
 
 
-def create_temp_table(db):
+def reserve_ids(db, count):
     """
-    Create temporary table to assign caop_id to line, point, admin.
+    Reserve a block of 'count' ids in seq_caop_id.
+
+    Ids are given downward (same as seq_caop_id), return the first one.
     """
 
+    # nextval then setval is not atomic, concurrent reservations wait on
+    # an advisory lock of the session (not kept until commit)
     cursor = db.cursor()
-
-    # Table converting id into unique id
-    logo.DEBUG("Create Temporary tables")
-    cursor.execute("""CREATE TEMPORARY TABLE caop_points (
-                        point_id int NOT NULL,
-                        caop_id bigint NOT NULL
-                          DEFAULT nextval('seq_caop_id'),
-                        PRIMARY KEY (point_id)
-                          )""")
-    cursor.execute("""SELECT AddGeometryColumn('caop_points', 'geom',
-                                               4326, 'POINT', 2)
+    cursor.execute("""SELECT pg_advisory_lock(
+                          'seq_caop_id'::regclass::oid::bigint)
                    """)
-    cursor.execute("""CREATE TEMPORARY TABLE caop_lines (
-                        line_id int NOT NULL,
-                        caop_id bigint NOT NULL
-                          DEFAULT nextval('seq_caop_id'),
-                        PRIMARY KEY (line_id)
-                          )""")
-    cursor.execute("""CREATE TEMPORARY TABLE caop_admins (
-                        admin_id int NOT NULL,
-                        caop_id bigint NOT NULL
-                          DEFAULT nextval('seq_caop_id'),
-                        name text NOT NULL,
-                        level int NOT NULL,
-                        PRIMARY KEY (admin_id)
-                      )""")
-    cursor.execute("""SELECT AddGeometryColumn('caop_admins', 'bbox',
-                                               4326, 'GEOMETRY', 2)
+    cursor.execute("""SELECT setval('seq_caop_id',
+                                    nextval('seq_caop_id') - %s + 1)
+                   """, (max(count, 1),))
+    lastid = cursor.fetchone()[0]
+    cursor.execute("""SELECT pg_advisory_unlock(
+                          'seq_caop_id'::regclass::oid::bigint)
                    """)
+    return lastid + max(count, 1) - 1
 
-    # Table for bulk copy content in lines/admins
-    cursor.execute("""CREATE TEMPORARY TABLE caop_linepts (
-                        line_id int NOT NULL,
-                        sequence_id int NOT NULL,
-                        point_id int NOT NULL,
-                        PRIMARY KEY (line_id, sequence_id)
-                      )""")
-    cursor.execute("""CREATE TEMPORARY TABLE caop_adminlines (
-                        admin_id int NOT NULL,
-                        line_id int NOT NULL,
-                        role text NOT NULL,
-                        sequence_id int NOT NULL,
-                        PRIMARY KEY (admin_id, sequence_id)
-                      )""")
 
-    db.commit()
+def line_levels(shapeu, admins):
+    """
+    Return array line id -> admin level of the way, the lowest level of
+    the areas where the line is outer (8 for other lines).
+    """
+
+    linelevel = array.array('b', [8] * (shapeu.nbrLines() + 1))
+    for adminid in admins.iterAdmins():
+        level = admins.getLevel(adminid)
+        if level < 8:
+            for lineid in admins.getLines(adminid, "outer"):
+                if linelevel[lineid] > level:
+                    linelevel[lineid] = level
+    return linelevel
+
+
+# Final tables, columns and their type for COPY : 'q' bigint, 'i' int,
+# 's' text, 'P' point (coordinates), 'R' polygon (list of coordinates)
+copytables = (
+    ("caop_nodes", ("caop_id", "geom"), "qP"),
+    ("caop_ways", ("caop_id",), "q"),
+    ("caop_way_nodes", ("caop_id", "node_id", "sequence_id"), "qqi"),
+    ("caop_way_tags", ("caop_id", "k", "v"), "qss"),
+    ("caop_relations", ("caop_id", "bbox"), "qR"),
+    ("caop_relation_members", ("caop_id", "member_id", "member_type",
+                               "member_role", "sequence_id"), "qqssi"),
+    ("caop_relation_tags", ("caop_id", "k", "v"), "qss"),
+)
+
+
+# Rows (tuple of values) of each final table, caop ids are given from
+# 'firstid' downward: point in iterPoints order, line 'lineid' and
+# admin 'adminid' get 'firstid - lineid + 1' and 'firstid - adminid'
+
+def node_array(shapeu):
+    """ Return array indexed by point id for node_rows. """
+    # 'q' is missing from Python 2 arrays, 'l' is 64 bits on Linux (an
+    # id out of range raises OverflowError)
+    return array.array('l', [0]) * shapeu.nbrPointIds()
+
+
+def node_rows(shapeu, firstid, nodeids):
+    """ Rows of caop_nodes, fill array 'nodeids' point id -> caop id. """
+    caopid = firstid
+    for pointid, coord in shapeu.iterPoints():
+        nodeids[pointid] = caopid
+        yield (caopid, coord)
+        caopid -= 1
+
+
+def way_rows(shapeu, firstid):
+    """ Rows of caop_ways. """
+    for lineid in xrange(1, shapeu.nbrLines()+1):
+        yield (firstid - lineid + 1,)
+
+
+def waynode_rows(shapeu, firstid, nodeids):
+    """ Rows of caop_way_nodes. """
+    for lineid, pntids in shapeu.iterLines():
+        caopid = firstid - lineid + 1
+        for sequenceid, pointid in enumerate(pntids):
+            yield (caopid, nodeids[pointid], sequenceid)
+
+
+def waytag_rows(shapeu, firstid):
+    """ Rows of caop_way_tags, without admin level. """
+    for lineid in xrange(1, shapeu.nbrLines()+1):
+        yield (firstid - lineid + 1, "boundary", "administrative")
+
+
+def waylevel_rows(shapeu, firstid, linelevel):
+    """ Rows of caop_way_tags for admin level (see line_levels). """
+    for lineid in xrange(1, shapeu.nbrLines()+1):
+        yield (firstid - lineid + 1, "admin_level", str(linelevel[lineid]))
+
+
+def relation_rows(admins, firstid):
+    """ Rows of caop_relations. """
+    for adminid in admins.iterAdmins():
+        x1, x2, y1, y2 = admins.getExtent(adminid)
+        yield (firstid - adminid,
+               ((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)))
+
+
+def member_rows(admins, firstid, wayfirstid):
+    """ Rows of caop_relation_members. """
+    for adminid in admins.iterAdmins():
+        caopid = firstid - adminid
+        sequenceid = 0
+        for role in ("outer", "inner"):
+            for lineid in admins.getLines(adminid, role):
+                yield (caopid, wayfirstid - lineid + 1, "W", role, sequenceid)
+                sequenceid += 1
+
+
+def relationtag_rows(admins, firstid):
+    """ Rows of caop_relation_tags. """
+    for adminid in admins.iterAdmins():
+        caopid = firstid - adminid
+        yield (caopid, "type", "boundary")
+        yield (caopid, "boundary", "administrative")
+        yield (caopid, "admin_level", str(admins.getLevel(adminid)))
+        yield (caopid, "name", admins.getName(adminid))
+
+
+def progress_rows(rows, progress):
+    """ Call 'progress' for each row. """
+    for row in rows:
+        progress()
+        yield row
+
+
+def text_point(coord):
+    return "SRID=4326;POINT(%.7f %.7f)" % coord
+
+
+def text_polygon(ring):
+    return "SRID=4326;POLYGON((%s))" % ",".join([ "%.7f %.7f" % coord
+                                                   for coord in ring ])
+
+
+def text_rows(rows, types):
+    """
+    Rows in COPY text format, geometries are EWKT with 7 digits.
+    """
+
+    fmt = "\t".join([ "%d" if t in "qi" else "%s" for t in types ]) + "\n"
+    geoms = [ (i, text_point if t == "P" else text_polygon)
+              for i, t in enumerate(types) if t in "PR" ]
+    if not geoms:
+        for row in rows:
+            yield fmt % row
+        return
+    for row in rows:
+        row = list(row)
+        for i, ewkt in geoms:
+            row[i] = ewkt(row[i])
+        yield fmt % tuple(row)
+
+
+# COPY binary format : header, each row has its number of fields then
+# each field is its length and its value (network byte order)
+PGCOPY_HEADER = "PGCOPY\n\377\r\n\0" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+BINARY_FIELDS = struct.Struct("!h")
+BINARY_BIGINT = struct.Struct("!iq")
+BINARY_INT = struct.Struct("!ii")
+BINARY_LENGTH = struct.Struct("!i")
+
+# Geometries are EWKB in big endian with SRID 4326 : byte order, type
+# with SRID flag, SRID then point coordinates or number of rings and
+# number of points for a polygon (the polygon starts with the length of
+# the field)
+EWKB_POINT = struct.Struct("!BIIdd")
+EWKB_POLYGON = struct.Struct("!iBIIII")
+
+
+def binary_bigint(value):
+    return BINARY_BIGINT.pack(8, value)
+
+
+def binary_int(value):
+    return BINARY_INT.pack(4, value)
+
+
+def binary_text(value):
+    return BINARY_LENGTH.pack(len(value)) + value
+
+
+def round_coords(coords):
+    """
+    Return list of coordinates x, y rounded to 7 digits.
+
+    Same values as the text format without formatting each number : the
+    coordinate is scaled by 1e7 and rounded, only when it is halfway
+    between 2 roundings (the product is not exact enough to choose) the
+    text format decides.
+    """
+
+    values = []
+    for x, y in coords:
+        x7 = x * 1e7
+        y7 = y * 1e7
+        xr = round(x7)
+        yr = round(y7)
+        if abs(x7 - xr) > 0.4999 or abs(y7 - yr) > 0.4999:
+            values.append(float("%.7f" % x))
+            values.append(float("%.7f" % y))
+        else:
+            values.append(xr / 1e7)
+            values.append(yr / 1e7)
+    return values
+
+
+def ewkb_point(coord):
+    # Same as round_coords for 1 point (called for each node)
+    x, y = coord
+    x7 = x * 1e7
+    y7 = y * 1e7
+    xr = round(x7)
+    yr = round(y7)
+    if abs(x7 - xr) > 0.4999 or abs(y7 - yr) > 0.4999:
+        return EWKB_POINT.pack(0, 0x20000001, 4326,
+                               float("%.7f" % x), float("%.7f" % y))
+    return EWKB_POINT.pack(0, 0x20000001, 4326, xr / 1e7, yr / 1e7)
+
+
+def binary_point(coord):
+    return BINARY_LENGTH.pack(EWKB_POINT.size) + ewkb_point(coord)
+
+
+def binary_polygon(ring):
+    coords = round_coords(ring)
+    points = struct.pack("!%dd" % len(coords), *coords)
+    return EWKB_POLYGON.pack(EWKB_POLYGON.size - 4 + len(points), 0,
+                             0x20000003, 4326, 1, len(ring)) + points
+
+
+# Fields with a fixed size : struct format of the length and the value,
+# length, function converting the value
+BINARY_FIXED = {
+    "q": ("iq", 8, None),
+    "i": ("ii", 4, None),
+    "P": ("i%ds" % EWKB_POINT.size, EWKB_POINT.size, ewkb_point),
+}
+
+
+def binary_rows(rows, types):
+    """
+    Rows in COPY binary format, geometries are EWKB with 7 digits.
+
+    The header is given before the first row and the trailer after
+    the last one. A row with only fixed size fields is packed at once.
+    """
+
+    yield PGCOPY_HEADER
+    if all([ t in BINARY_FIXED for t in types ]):
+        # Lengths are constant, values are put at their place (every
+        # other argument) in the arguments of the whole row
+        rowstruct = struct.Struct("!h" + "".join([ BINARY_FIXED[t][0]
+                                                   for t in types ]))
+        args = [ len(types) ]
+        for t in types:
+            args.extend( (BINARY_FIXED[t][1], None) )
+        geoms = [ (i, 2*i + 2, BINARY_FIXED[t][2])
+                  for i, t in enumerate(types) if BINARY_FIXED[t][2] ]
+        for row in rows:
+            args[2::2] = row
+            for i, pos, ewkb in geoms:
+                args[pos] = ewkb(row[i])
+            yield rowstruct.pack(*args)
+    else:
+        encoders = [ { "q": binary_bigint, "i": binary_int,
+                       "s": binary_text, "P": binary_point,
+                       "R": binary_polygon }[t]
+                     for t in types ]
+        fields = BINARY_FIELDS.pack(len(types))
+        for row in rows:
+            yield fields + "".join([ encoder(value)
+                                     for encoder, value in zip(encoders,
+                                                               row) ])
+    yield PGCOPY_TRAILER
+
+
+def table_types(table):
+    """
+    Return columns and their types of one of the final tables.
+    """
+
+    for name, columns, types in copytables:
+        if name == table:
+            return columns, types
+    raise ValueError("'%s' is not a caop table" % table)
+
+
+def copy_file(cursor, table, f, binary=None):
+    """
+    COPY a file object in text or binary format into a final table.
+
+    The format is given by caop_config.copybinary if 'binary' is None.
+    """
+
+    if binary is None:
+        binary = caop_config.copybinary
+    columns, types = table_types(table)
+    if binary:
+        cursor.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT binary)"
+                           % (table, ", ".join(columns)), f,
+                           size=caop_config.copychunk)
+    else:
+        cursor.copy_from(f, table, columns=columns,
+                         size=caop_config.copychunk)
+
+
+def copy_rows(cursor, table, rows, binary=None):
+    """
+    COPY rows (tuples of values) into a final table, see copy_file.
+    """
+
+    if binary is None:
+        binary = caop_config.copybinary
+    columns, types = table_types(table)
+    if binary:
+        rows = binary_rows(rows, types)
+    else:
+        rows = text_rows(rows, types)
+    copy_file(cursor, table, CopyStream(rows), binary)
+
+
+def export_caop(shapeu, admins, firstid, files, binary=None):
+    """
+    Write all nodes, ways, relations in COPY format for the final tables.
+
+    Unique ids are given from 'firstid' downward (same as seq_caop_id),
+    'files' is a dictionary table name -> file object.
+    The binary or text format is given by caop_config.copybinary.
+    Return the last id used.
+    """
+
+    if binary is None:
+        binary = caop_config.copybinary
+    nodeids = node_array(shapeu)
+    wayfirstid = firstid - shapeu.nbrPoints()
+    relfirstid = wayfirstid - shapeu.nbrLines()
+    tablerows = {
+        "caop_nodes": node_rows(shapeu, firstid, nodeids),
+        "caop_ways": way_rows(shapeu, wayfirstid),
+        "caop_way_nodes": waynode_rows(shapeu, wayfirstid, nodeids),
+        "caop_way_tags": itertools.chain(waytag_rows(shapeu, wayfirstid),
+                               waylevel_rows(shapeu, wayfirstid,
+                                             line_levels(shapeu, admins))),
+        "caop_relations": relation_rows(admins, relfirstid),
+        "caop_relation_members": member_rows(admins, relfirstid,
+                                             wayfirstid),
+        "caop_relation_tags": relationtag_rows(admins, relfirstid),
+    }
+    for table, columns, types in copytables:
+        if binary:
+            rows = binary_rows(tablerows[table], types)
+        else:
+            rows = text_rows(tablerows[table], types)
+        files[table].writelines(rows)
+    return relfirstid - admins.nbrAdmins() + 1
 
 
 def import_caop(db, shapeu, admins):
@@ -534,127 +1176,284 @@ def import_caop(db, shapeu, admins):
     Import with an unique id all nodes, ways, relations.
     """
 
-    cursor = db.cursor()
     logo.starting("Saving nodes, ways, relations",
-                  shapeu.nbrPoints() + shapeu.nbrLines() + len(admins))
+                  shapeu.nbrPoints() + shapeu.nbrLines() + admins.nbrAdmins())
+    nodeids = import_nodes(db, shapeu)
+    wayfirstid = import_ways(db, shapeu, nodeids)
+    del nodeids
+    import_relations(db, shapeu, admins, wayfirstid)
+    db.commit()
+    logo.ending()
+
+
+class CopyStream:
+    """
+    File object reading rows for copy_from from an iterator.
+
+    Rows are formatted only when COPY asks for data, at most one chunk
+    is kept in memory. The chunk size defaults to caop_config.copychunk
+    when read() is called.
+    """
+
+    def __init__(self, rows, chunksize=None):
+        self.rows = iter(rows)
+        self.chunksize = chunksize
+        self.buffer = ""
+
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunksize
+            if size is None:
+                size = caop_config.copychunk
+        parts = [ self.buffer ]
+        length = len(self.buffer)
+        while length < size:
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                break
+            parts.append(row)
+            length += len(row)
+        data = "".join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+    def readline(self, size=-1):
+        while "\n" not in self.buffer:
+            try:
+                self.buffer += self.rows.next()
+            except StopIteration:
+                break
+        pos = self.buffer.find("\n") + 1
+        if pos == 0:
+            pos = len(self.buffer)
+        data = self.buffer[:pos]
+        self.buffer = self.buffer[pos:]
+        return data
+
+
+def import_nodes(db, shapeu, progress=logo.progress):
+    """
+    Import with an unique id all nodes.
+
+    Return array point id -> node id.
+    """
 
     # Points -> Nodes
-    # - bulk copy to a temp table to get a new unique id
-    # - do only one big insert with new ids to the finale table
+    # - reserve ids for all points, copy directly to the final table
     logo.DEBUG("Write nodes to database")
-    buffcopy = StringIO()
-    for pointid, coord in shapeu.iterPoints():
-        logo.progress()
-        pointEwkt = "SRID=4326;POINT(%.7f %.7f)" % (coord[0], coord[1])
-        buffcopy.write("%d\t%s\n" % (pointid, pointEwkt))
-    buffcopy.seek(0)
-    cursor.copy_from(buffcopy, 'caop_points', columns=('point_id', 'geom'))
-    cursor.execute("""INSERT INTO caop_nodes (caop_id, geom)
-                      SELECT caop_id, geom FROM caop_points
-                   """)
-    db.commit()
-    buffcopy.close()
+    firstid = reserve_ids(db, shapeu.nbrPoints())
+    nodeids = node_array(shapeu)
+    cursor = db.cursor()
+    copy_rows(cursor, 'caop_nodes',
+              progress_rows(node_rows(shapeu, firstid, nodeids), progress))
+    return nodeids
+
+
+def import_ways(db, shapeu, nodeids, progress=logo.progress):
+    """
+    Import with an unique id all ways (nodes must be imported).
+
+    Return the id of the first way (line 1), ids of next lines are
+    going downward.
+    """
 
     # Lines -> Ways
-    # - bulk copy to a temp table to get a new unique id
-    # - bulk copy points in lines in a temp table
-    # - insert all ways with new ids as administrative level 8
+    # - reserve ids for all lines, copy directly to the final tables
+    # - admin level tags are written with relations
     logo.DEBUG("Write ways to database")
-    buffcopy1 = StringIO()
-    buffcopy2 = StringIO()
-    for lineid, pntids in shapeu.iterLines():
-        logo.progress()
-        buffcopy1.write("%d\n" % lineid)
-        for orderpntid in enumerate(pntids):
-            buffcopy2.write("%d\t" % lineid)
-            buffcopy2.write("%d\t%d\n" % orderpntid)
-    buffcopy1.seek(0)
-    cursor.copy_from(buffcopy1, 'caop_lines', columns=('line_id',))
-    cursor.execute("""INSERT INTO caop_ways (caop_id)
-                      SELECT caop_id FROM caop_lines
-                   """)
-    buffcopy2.seek(0)
-    cursor.copy_from(buffcopy2, 'caop_linepts')
-    cursor.execute("""INSERT INTO caop_way_nodes
-                      SELECT A.caop_id, B.caop_id, C.sequence_id
-                      FROM caop_lines A, caop_points B, caop_linepts C
-                      WHERE A.line_id = C.line_id
-                      AND C.point_id = B.point_id
-                   """)
-    cursor.execute("""INSERT INTO caop_way_tags
-                      SELECT caop_id, 'boundary', 'administrative'
-                      FROM caop_lines
-                   """)
-    cursor.execute("""INSERT INTO caop_way_tags
-                      SELECT caop_id, 'admin_level', 8
-                      FROM caop_lines
-                   """)
-    db.commit()
-    buffcopy1.close()
-    buffcopy2.close()
+    firstid = reserve_ids(db, shapeu.nbrLines())
+    cursor = db.cursor()
+    copy_rows(cursor, 'caop_ways',
+              progress_rows(way_rows(shapeu, firstid), progress))
+    copy_rows(cursor, 'caop_way_nodes', waynode_rows(shapeu, firstid, nodeids))
+    copy_rows(cursor, 'caop_way_tags', waytag_rows(shapeu, firstid))
+    return firstid
+
+
+def import_relations(db, shapeu, admins, wayfirstid, progress=logo.progress):
+    """
+    Import with an unique id all relations (ways must be imported).
+    """
 
     # Admins -> Relations
-    # - bulk copy to a temp table to get a new unique id
-    # - bulk copy lines in admins in a temp table
-    # - correct outer ways administrative level
-    # - insert all tags for administrative area
+    # - copy ways administrative level (lowest level of its areas)
+    # - reserve ids for all admins, copy directly to the final tables
     logo.DEBUG("Write relations to database")
-    buffcopy1 = StringIO()
-    buffcopy2 = StringIO()
-    for (num,dicofre) in enumerate(admins):
-        logo.progress()
-        buffcopy1.write("%d\t" % num)
-        buffcopy1.write("%(name)s\t%(level)d\t" % admins[dicofre])
-        buffcopy1.write("SRID=4326;POLYGON((%(x1).7f %(y1).7f,%(x1).7f %(y2).7f,%(x2).7f %(y2).7f,%(x2).7f %(y1).7f,%(x1).7f %(y1).7f))\n" % dict(zip(['x1', 'x2', 'y1', 'y2'], admins[dicofre]['bbox'])) )
-        sequenceid = 0
-        for role in ("outer", "inner"):
-            for lineid in admins[dicofre][role]:
-                buffcopy2.write("%d\t%d\t%s\t%d\n" % (
-                                num, lineid, role, sequenceid))
-                sequenceid += 1
-        if admins[dicofre]['level'] < 8:
-            cursor.execute("""UPDATE caop_way_tags SET v = %(level)s
-                              FROM caop_lines A
-                              WHERE caop_way_tags.caop_id = A.caop_id
-                              AND A.line_id IN %(outer)s
-                              AND k = 'admin_level'
-                              AND v::int > %(level)s
-                           """, admins[dicofre])
-    db.commit()
-    buffcopy1.seek(0)
-    cursor.copy_from(buffcopy1, 'caop_admins', columns=('admin_id', 'name',
-                                                        'level', 'bbox'))
-    cursor.execute("""INSERT INTO caop_relations (caop_id, bbox)
-                      SELECT caop_id, bbox FROM caop_admins
-                   """)
-    buffcopy2.seek(0)
-    cursor.copy_from(buffcopy2, 'caop_adminlines')
-    cursor.execute("""INSERT INTO caop_relation_members
-                      SELECT A.caop_id, B.caop_id, 'W', C.role, C.sequence_id
-                      FROM caop_admins A, caop_lines B, caop_adminlines C
-                      WHERE A.admin_id = C.admin_id
-                      AND C.line_id = B.line_id
-                   """)
-    cursor.execute("""INSERT INTO caop_relation_tags
-                      SELECT caop_id, 'type', 'boundary'
-                      FROM caop_admins
-                   """)
-    cursor.execute("""INSERT INTO caop_relation_tags
-                      SELECT caop_id, 'boundary', 'administrative'
-                      FROM caop_admins
-                   """)
-    cursor.execute("""INSERT INTO caop_relation_tags
-                      SELECT caop_id, 'admin_level', level::text
-                      FROM caop_admins
-                   """)
-    cursor.execute("""INSERT INTO caop_relation_tags
-                      SELECT caop_id, 'name', name
-                      FROM caop_admins
-                   """)
-    db.commit()
-    buffcopy1.close()
-    buffcopy2.close()
-    logo.ending()
+    cursor = db.cursor()
+    copy_rows(cursor, 'caop_way_tags',
+              waylevel_rows(shapeu, wayfirstid, line_levels(shapeu, admins)))
+    firstid = reserve_ids(db, admins.nbrAdmins())
+    copy_rows(cursor, 'caop_relations',
+              progress_rows(relation_rows(admins, firstid), progress))
+    copy_rows(cursor, 'caop_relation_members',
+              member_rows(admins, firstid, wayfirstid))
+    copy_rows(cursor, 'caop_relation_tags', relationtag_rows(admins, firstid))
+
+
+class ImportThread(threading.Thread):
+    """
+    Import nodes and ways in background with its own DB connection.
+
+    Relations are imported when the admin areas are given (see finish),
+    everything is in one transaction committed only after relations.
+    """
+
+    def __init__(self, dbname, shapeu):
+        threading.Thread.__init__(self)
+        self.daemon = True        # do not wait relations if main fails
+        self.dbname = dbname
+        self.shapeu = shapeu
+        self.admins = Queue.Queue(1)
+        self.error = None
+
+
+    def run(self):
+        try:
+            db = psycopg2.connect(self.dbname)
+            logo.DEBUG("Background import of nodes and ways")
+            nodeids = import_nodes(db, self.shapeu, progress=lambda: None)
+            wayfirstid = import_ways(db, self.shapeu, nodeids,
+                                     progress=lambda: None)
+            del nodeids
+            logo.DEBUG("Background import of nodes and ways done")
+            admins = self.admins.get()
+            if admins is None:
+                db.rollback()
+            else:
+                logo.starting("Saving relations", admins.nbrAdmins())
+                import_relations(db, self.shapeu, admins, wayfirstid)
+                db.commit()
+                logo.ending()
+            db.close()
+        except:
+            self.error = sys.exc_info()
+
+
+    def finish(self, admins):
+        """
+        Import relations of 'admins' and commit, or rollback nodes and
+        ways with None, then wait the end.
+        """
+
+        try:
+            self.admins.put(admins, False)
+        except Queue.Full:
+            pass
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+def build_region(num, filenames, firstid, blocksize, workdir, results,
+                 processes):
+    """
+    Run the whole build for one region (list of shapefiles).
+
+    Run in its own process, COPY files are written in 'workdir' and
+    the status is put in the 'results' queue (region number, None or
+    the error). Areas are verified with 'processes' processes.
+    """
+
+    try:
+        # Progress meters of all regions would be mixed on stdout
+        logo.quiet = True
+        caop_config.processes = processes
+        shapeu = ShapeUtil(caop_config.cachesize)
+        for filename in filenames:
+            logo.INFO("Reading geometries '%s'" % filename)
+            read_CAOP(filename, shapeu)
+        shapeu.buildSimplifiedLines()
+        admins = AdminUtil()
+        for filename in filenames:
+            admin_CAOP(filename, shapeu, admins)
+        verify_admin(shapeu, admins)
+
+        nbrids = shapeu.nbrPoints() + shapeu.nbrLines() + admins.nbrAdmins()
+        if nbrids > blocksize:
+            raise ValueError("Region '%s' needs %d ids, more than %d reserved"
+                             % (', '.join(filenames), nbrids, blocksize))
+        files = {}
+        for table, columns, types in copytables:
+            files[table] = open(os.path.join(workdir,
+                                             "%d_%s.copy" % (num, table)), "wb")
+        export_caop(shapeu, admins, firstid, files)
+        for output in files.itervalues():
+            output.close()
+        results.put( (num, None) )
+    except:
+        results.put( (num, traceback.format_exc()) )
+
+
+def build_regions(db, regions):
+    """
+    Build each region (list of shapefiles) in its own process and load
+    all regions together.
+
+    Each region uses a block of ids reserved in seq_caop_id and its
+    share of the processes verifying areas.
+    """
+
+    blocksize = caop_config.regionidblock
+    firstid = reserve_ids(db, len(regions) * blocksize)
+    processes = max(1, (caop_config.processes or multiprocessing.cpu_count())
+                       // len(regions))
+
+    workdir = tempfile.mkdtemp(prefix="caop")
+    try:
+        results = multiprocessing.Queue()
+        builders = []
+        for num, filenames in enumerate(regions):
+            logo.INFO("Building region %d from '%s'"
+                      % (num, ', '.join(filenames)))
+            logo.flush()
+            builder = multiprocessing.Process(target=build_region,
+                             args=(num, filenames, firstid - num * blocksize,
+                                   blocksize, workdir, results, processes))
+            builder.start()
+            builders.append(builder)
+
+        # A region killed before putting its status is an error too
+        errors = {}
+        while len(errors) < len(builders):
+            try:
+                num, error = results.get(timeout=10)
+                errors[num] = error
+            except Queue.Empty:
+                ended = [ num for num, builder in enumerate(builders)
+                          if num not in errors and not builder.is_alive() ]
+                while True:
+                    try:
+                        num, error = results.get_nowait()
+                    except Queue.Empty:
+                        break
+                    errors[num] = error
+                for num in ended:
+                    if num not in errors:
+                        errors[num] = ("Process ended with exit code %s"
+                                       % builders[num].exitcode)
+        for builder in builders:
+            builder.join()
+        for num in sorted(errors):
+            if errors[num]:
+                logo.ERROR("Region %d failed:\n%s" % (num, errors[num]))
+        if [ num for num in errors if errors[num] ]:
+            raise logo.ERROR("Regions not imported")
+
+        # One transaction for all regions
+        logo.INFO("Importing regions into database")
+        cursor = db.cursor()
+        for table, columns, types in copytables:
+            logo.DEBUG("Copy %s" % table)
+            for num in xrange(len(regions)):
+                with open(os.path.join(workdir,
+                                       "%d_%s.copy" % (num, table)), "rb") as f:
+                    copy_file(cursor, table, f)
+        db.commit()
+    finally:
+        shutil.rmtree(workdir)
 
 
 def vacuum_analyze_db(db):
@@ -704,7 +1503,16 @@ def main():
     if not check_db_caop(db):
         logo.INFO("Creating PostgreSQL tables")
         create_caop_table(db)
-    create_temp_table(db)
+
+    if caop_config.regionparallel:
+        # Each argument is a region, with shapefiles separated by ','
+        if caop_config.lookupindex:
+            logo.WARN("No freguesia lookup index with regionparallel,"
+                      " '%s' not written" % caop_config.lookupindex)
+        build_regions(db, [ arg.split(',') for arg in sys.argv[1:] ])
+        vacuum_analyze_db(db)
+        logo.close()
+        return
 
     shapeu = ShapeUtil(caop_config.cachesize)
     for i in xrange(1, len(sys.argv)):
@@ -714,15 +1522,46 @@ def main():
     logo.INFO("Simplify geometries")
     shapeu.buildSimplifiedLines()
 
-    logo.INFO("Building administrative area")
-    admins = {}
-    for i in xrange(1, len(sys.argv)):
-        admin_CAOP(sys.argv[i], shapeu, admins)
-    logo.INFO("Verifying administrative area")
-    verify_admin(shapeu, admins)
+    # Processes verifying areas are started before the import thread and
+    # its database connection
+    pool = verify_pool(shapeu)
+    importer = None
+    try:
+        # Nodes and ways are final, import them while building and
+        # verifying administrative area
+        if caop_config.importthread:
+            importer = ImportThread(caop_config.dbname, shapeu)
+            importer.start()
+
+        logo.INFO("Building administrative area")
+        admins = AdminUtil()
+        for i in xrange(1, len(sys.argv)):
+            admin_CAOP(sys.argv[i], shapeu, admins)
+        logo.INFO("Verifying administrative area")
+        verify_admin(shapeu, admins, pool)
+    except:
+        if importer:
+            # Nothing is written in the database when verification fails
+            error = sys.exc_info()
+            try:
+                importer.finish(None)
+            except:
+                pass
+            raise error[0], error[1], error[2]
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if caop_config.lookupindex:
+        logo.INFO("Writing freguesia lookup index '%s'"
+                  % caop_config.lookupindex)
+        writeLookupIndex(caop_config.lookupindex, shapeu, admins)
 
     logo.INFO("Importing into database")
-    import_caop(db, shapeu, admins)
+    if importer:
+        importer.finish(admins)
+    else:
+        import_caop(db, shapeu, admins)
     vacuum_analyze_db(db)
     logo.close()
 
@@ -56,6 +56,55 @@ progress = True
 # hungry), a reasonable value is the number of points in the Shapefile.
 cachesize = 3800000
 
+# planarrings = build rings of admin area walking around each node, it is
+#               much faster than the search with backtracking used for the
+#               areas which cannot be done this way (or always if False)
+planarrings = True
+
+# ringbacktrack + ringtimeout = limits (number of backtrack, seconds) when
+#               searching the rings of one admin area, lines not in a closed
+#               ring at this point are discarded (None for no limit)
+ringbacktrack = 200000
+ringtimeout = 300
+
+# processes = number of processes used to verify admin areas (None for the
+#             number of CPUs, 1 to verify all areas in the main process)
+#             Areas are verified level by level, with 1 process all areas
+#             share the ring validity cache, with more processes an area
+#             only gets the rings of its lines checked at lower levels
+#             (a ring of 2 areas of the same level verified in 2
+#             processes is checked twice)
+processes = None
+
+# importthread = import nodes and ways in a background thread (with its own
+#                DB connection) while administrative areas are verified
+importthread = True
+
+# regionparallel = build each region in its own process and load all of them
+#                  at once, each argument of caop_build is then a region
+#                  (shapefiles of a same region separated by ',')
+# regionidblock = number of ids reserved in seq_caop_id for each region
+regionparallel = False
+regionidblock = 100000000
+
+# lookupindex = file name of an index finding the freguesia of a coordinate
+#               (see lookupu.LookupIndex), None to not build it
+lookupindex = None
+
+# serversocket = Unix socket of caop_server (resident topology), created
+#                with mode 0600 so only the same user can send commands,
+#                a stale socket left by a previous server is replaced
+serversocket = "/tmp/caop.sock"
+
+# copychunk = size in bytes of each block of rows formatted while sending
+#             data to the database with COPY
+copychunk = 65536
+
+# copybinary = send data to the database with COPY in binary format
+#              (geometries as EWKB) instead of text, the database must
+#              accept COPY ... WITH (FORMAT binary) (PostgreSQL 9.0)
+copybinary = False
+
 if __name__ == '__main__':
     print "***WARNING*** THIS FILE IS NOT MEANT TO BE RUN"
     print "It is used to set some global configuration variable used by 'caop' programs."
@@ -297,11 +297,20 @@ class MatchRelationGeom(MatchRelation):
     Compare CAOP relation with OSM relation using geometry.
     """
 
+    def __init__(self, db):
+        MatchRelation.__init__(self, db)
+
+        # Keep builders (and their cache of line coordinates) for
+        # all relations, ways are shared by many relations
+        self.caoprings = DBGeometryRingCAOP(db)
+        self.osmrings = DBGeometryRingOSM(db)
+
+
     def do_search_admin(self, caop_id):
         cursor = self.db.cursor()
 
         # Build geometry for CAOP relation
-        DBGeometryRingCAOP(self.db).buildgeometry(caop_id)
+        self.caoprings.buildgeometry(caop_id)
 
         # Build geometry for OSM relations involved in comparison (if any
         # and if not already build)
@@ -313,7 +322,7 @@ class MatchRelationGeom(MatchRelation):
         build_list = [ data[0] for data in cursor.fetchall() ]
         if build_list:
             for osm_id in build_list:
-                DBGeometryRingOSM(self.db).buildgeometry(osm_id)
+                self.osmrings.buildgeometry(osm_id)
             # Keep OSM geometry as multipolygons
             cursor.execute("""UPDATE matching_relation A
                               SET geom = B.geom
@@ -357,6 +366,7 @@ class DBGeometryRing:
 
     def __init__(self, db):
         self.db = db
+        self.linecache = ringue.LineCache(self)
 
 
     def buildgeometry(self, adminid):
@@ -367,9 +377,25 @@ class DBGeometryRing:
         """
 
         lines = self.getOuterMembers(adminid)
-        rings = ringue.FindClosedRings(self, lines)
+        rings = ringue.FindClosedRings(self, lines, linecache=self.linecache,
+                                       maxbacktrack=caop_config.ringbacktrack,
+                                       maxtime=caop_config.ringtimeout)
+        if rings.overbudget:
+            logo.WARN("Relation %d rings search stopped after %d backtracks (%.1fs)"
+                      % (adminid, rings.nbrbacktrack, rings.elapsed))
         for ringnum in range(rings.nbrRing()):
-            points = rings.build_geometry_ring(ringnum)
+            points = rings.getGeometryRing(ringnum)
+            self.savebuildring(adminid, ringnum, points)
+
+        # Closed rings crossing each other are discarded by FindClosedRings
+        # but still part of the relation, save them too
+        crossrings = set()
+        for ring1, ring2, coord in rings.iterRingCrossing():
+            logo.WARN("Relation %d rings cross each other at %.7f %.7f"
+                      % (adminid, coord[0], coord[1]))
+            crossrings.update( (ring1, ring2) )
+        for ringnum, ring in enumerate(sorted(crossrings), rings.nbrRing()):
+            points = rings.getGeometryDiscarded(ring)
             self.savebuildring(adminid, ringnum, points)
         self.db.commit()
 
@@ -387,6 +413,25 @@ class DBGeometryRing:
         return result
 
 
+    def _group_lines(self, rows):
+        """
+        Group rows (lineid, pointid, lon, lat) ordered by line and
+        sequence, return a dictionary lineid -> (ends, coordinates).
+        """
+
+        lines = {}
+        for lineid, pointid, lon, lat in rows:
+            if lineid not in lines:
+                lines[lineid] = ([], [])
+            pointids, coords = lines[lineid]
+            pointids.append(pointid)
+            if lon is not None:
+                coords.append( (lon, lat) )
+        for lineid, (pointids, coords) in lines.iteritems():
+            lines[lineid] = ( (pointids[0], pointids[-1]), coords )
+        return lines
+
+
     def savebuildring(self, adminid, ringnumber, points):
         """
         Save ring geometry as a polygon.
@@ -469,6 +514,26 @@ class DBGeometryRingOSM(DBGeometryRing):
         return points
 
 
+    def getLinesEndsCoords(self, lineids):
+        """
+        Return first and last node with coordinates for all nodes of
+        each way in 'lineids' (only 1 query).
+        """
+
+        if not lineids:
+            return {}
+        cursor = self.db.cursor()
+        cursor.execute("""SELECT B.way_id, B.node_id, ST_X(A.geom), ST_Y(A.geom)
+                          FROM way_nodes B LEFT JOIN nodes A
+                            ON A.id = B.node_id
+                          WHERE B.way_id IN %s
+                          ORDER BY B.way_id, B.sequence_id
+                       """, (tuple(lineids),) )
+        lines = self._group_lines(cursor.fetchall())
+        cursor.close()
+        return lines
+
+
 class DBGeometryRingCAOP(DBGeometryRing):
     """
     Building outer rings geometry from CAOP relation.
@@ -529,6 +594,26 @@ class DBGeometryRingCAOP(DBGeometryRing):
         return points
 
 
+    def getLinesEndsCoords(self, lineids):
+        """
+        Return first and last node with coordinates for all nodes of
+        each way in 'lineids' (only 1 query).
+        """
+
+        if not lineids:
+            return {}
+        cursor = self.db.cursor()
+        cursor.execute("""SELECT B.caop_id, B.node_id, ST_X(A.geom), ST_Y(A.geom)
+                          FROM caop_way_nodes B LEFT JOIN caop_nodes A
+                            ON A.caop_id = B.node_id
+                          WHERE B.caop_id IN %s
+                          ORDER BY B.caop_id, B.sequence_id
+                       """, (tuple(lineids),) )
+        lines = self._group_lines(cursor.fetchall())
+        cursor.close()
+        return lines
+
+
 def main():
     logo.init(filename = caop_config.logfile,
               verbose = caop_config.verbose,
@@ -549,6 +634,10 @@ def main():
     logo.INFO("Search existing admin area by geometry")
     for adminlevel in (8, 7, 6, 4):
         matching.link_caop_osm(adminlevel)
+    for rings in (matching.caoprings, matching.osmrings):
+        logo.DEBUG("%s line cache %d hits, %d misses (%.1f%%)" % (
+                   rings.__class__.__name__, rings.linecache.hits,
+                   rings.linecache.misses, rings.linecache.hitrate()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2013
+#    Francisco Dos Santos <f.dos.santos@free.fr>
+
+"""
+Keep the CAOP topology in memory and answer commands on a Unix socket.
+
+Start with the same shapefiles as caop_build, then send one command
+per line (i.e. with 'socat - UNIX-CONNECT:/tmp/caop.sock') :
+- VERIFY dicofre : check again the rings of an area
+- RELOAD dicofre : reread polygons of a freguesia from the shapefiles
+                   and check again the freguesia and its upper areas
+                   (rings and inner lines)
+- EXPORT dicofre : return geometry of an area as WKT
+- SHUTDOWN       : stop the server
+Each answer ends with a line starting with OK or ERROR.
+Only the user running the server can connect to the socket.
+"""
+
+import sys
+import os
+import stat
+import SocketServer
+from shapeu import ShapeUtil
+from adminu import AdminUtil
+import caop_build
+import logo
+import caop_config
+
+
+class TopologyHandler(SocketServer.StreamRequestHandler):
+    """
+    Read commands from a client until disconnection.
+    """
+
+    def handle(self):
+        while not self.server.stopping:
+            line = self.rfile.readline()
+            if not line:
+                break
+            words = line.split()
+            if not words:
+                continue
+            command = getattr(self.server, "command_" + words[0].lower(),
+                              None)
+            if command is None:
+                answer = [ "ERROR unknown command '%s'" % words[0] ]
+            else:
+                try:
+                    answer = command(*words[1:])
+                except Exception, e:
+                    answer = [ "ERROR %s" % e ]
+            self.wfile.write("".join([ text + "\n" for text in answer ]))
+            self.wfile.flush()
+
+
+class TopologyServer(SocketServer.UnixStreamServer):
+    """
+    Resident ShapeUtil and AdminUtil, one client at a time.
+    """
+
+    def __init__(self, path, filenames, shapeu, admins):
+        if os.path.lexists(path):
+            # Stale socket of a previous server, never remove another file
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError("'%s' exists and is not a socket" % path)
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, TopologyHandler)
+        self.filenames = filenames
+        self.shapeu = shapeu
+        self.admins = admins
+        self.stopping = False
+
+
+    def server_bind(self):
+        # Only the owner can connect, the socket is never accessible
+        # to other users even between bind and chmod
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0600)
+
+
+    def _getadmin(self, dicofre):
+        adminid = self.admins.getAdmin(dicofre)
+        if adminid is None:
+            raise ValueError("unknown DICOFRE '%s'" % dicofre)
+        return adminid
+
+
+    def _status(self, adminid, result):
+        valid, stats, crossing, discarded, innerrings, rings = result
+        text = "%s '%s' level=%d %d outer lines, %d inner lines" % (
+               self.admins.getCode(adminid), self.admins.getName(adminid),
+               self.admins.getLevel(adminid),
+               len(self.admins.getLines(adminid, "outer")),
+               len(self.admins.getLines(adminid, "inner")) )
+        if valid:
+            return "OK %s" % text
+        return "ERROR %s, %d crossing and %d discarded rings" % (
+               text, len(crossing), len(discarded))
+
+
+    def command_verify(self, dicofre):
+        adminid = self._getadmin(dicofre)
+        result = caop_build.verify_area(self.shapeu, self.admins, adminid)
+        return [ self._status(adminid, result) ]
+
+
+    def command_reload(self, dicofre):
+        updated = caop_build.reload_admin(self.filenames, self.shapeu,
+                                          self.admins, dicofre)
+        if updated is None:
+            raise ValueError("'%s' is not a freguesia" % dicofre)
+        answer = []
+        for adminid in updated:
+            result = caop_build.verify_area(self.shapeu, self.admins,
+                                            adminid)
+            answer.append(self._status(adminid, result))
+        nbrerror = caop_build.verify_inner(self.admins, updated)
+        if nbrerror:
+            answer.append("ERROR %d inner lines not used once as outer line"
+                          % nbrerror)
+        answer.append("OK %d areas reloaded" % len(updated))
+        return answer
+
+
+    def command_export(self, dicofre):
+        adminid = self._getadmin(dicofre)
+        lines = set(self.admins.getLines(adminid, "outer"))
+        lines.update(self.admins.getLines(adminid, "inner"))
+        rings = caop_build.verifystate["findrings"](self.shapeu, lines)
+        polygons = []
+        for outer, inner in rings.iterPolygons():
+            polygons.append("(%s)" % ",".join([
+                  "(%s)" % ",".join([ "%.7f %.7f" % coord for coord in
+                                      rings.getGeometryRing(ring) ])
+                  for ring in [ outer ] + inner ]))
+        return [ "MULTIPOLYGON(%s)" % ",".join(polygons),
+                 self._status(adminid, (rings.isValid(), None,
+                                        list(rings.iterRingCrossing()),
+                                        list(rings.iterRingDiscarded()),
+                                        None, None)) ]
+
+
+    def command_shutdown(self):
+        self.stopping = True
+        return [ "OK shutdown" ]
+
+
+def main():
+    logo.init(filename = caop_config.logfile,
+              verbose = caop_config.verbose,
+              progress = caop_config.progress)
+    if len(sys.argv) < 2:
+        raise logo.ERROR("Missing input Shapefile")
+    filenames = sys.argv[1:]
+
+    shapeu = ShapeUtil(caop_config.cachesize)
+    for filename in filenames:
+        logo.INFO("Reading geometries '%s'" % filename)
+        caop_build.read_CAOP(filename, shapeu)
+
+    logo.INFO("Simplify geometries")
+    shapeu.buildSimplifiedLines()
+
+    logo.INFO("Building administrative area")
+    admins = AdminUtil()
+    for filename in filenames:
+        caop_build.admin_CAOP(filename, shapeu, admins)
+    logo.INFO("Verifying administrative area")
+    caop_build.verify_admin(shapeu, admins)
+
+    server = TopologyServer(caop_config.serversocket, filenames, shapeu,
+                            admins)
+    logo.INFO("Waiting commands on '%s'" % caop_config.serversocket)
+    while not server.stopping:
+        server.handle_request()
+    server.server_close()
+    os.unlink(caop_config.serversocket)
+    logo.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -169,6 +169,28 @@ def close(title=''):
     filelog = None
 
 
+def flush():
+    """
+    Write pending messages (i.e. before starting a new process).
+    """
+
+    if filelog:
+        filelog.flush()
+    stdout.flush()
+
+
+def silence():
+    """
+    Stop all messages in this process, the log file stays open for
+    the other processes sharing it.
+    """
+
+    global filelog, quiet
+
+    filelog = None
+    quiet = True
+
+
 def starting(text, nb):
     """
     Start a percent progression meter.
@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2013
+#    Francisco Dos Santos <f.dos.santos@free.fr>
+
+"""
+Find the freguesia containing a coordinate using an index file.
+
+File layout (little endian) :
+- header (see HEADER)
+- for each area : DICOFRE, municipio, distrito/region codes, bounding
+  box of its edges in latitude, number of latitude bands, first band
+- for each grid cell : (value, count), with count = 0 value is the area
+  covering the whole cell (or -1), else the first of 'count' candidates
+- candidates : area numbers
+- for each band : (first edge, number of edges)
+- edges : x1, y1, x2, y2
+"""
+
+import math
+import mmap
+import struct
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from ringue import BandedEdges, bandnumber, edgescontains, gridcells
+
+MAGIC = "CAOPIDX1"
+HEADER = struct.Struct("<8sddddiiiiii")   # magic, xmin, ymin, cellsize x 2,
+                                          # nx, ny, nb area/cand/band/edge
+AREA = struct.Struct("<6s6s6sddii")       # codes, ymin, height, nb, first
+CELL = struct.Struct("<ii")
+INT = struct.Struct("<i")
+BAND = struct.Struct("<ii")
+EDGE = struct.Struct("<dddd")
+
+# Number of point x edge tests done at once by lookupMany with NumPy
+LOOKUPCHUNK = 1 << 20
+
+
+def writeLookupIndex(filename, shapeu, admins, gridsize=512):
+    """
+    Write index file of freguesias (admin level 8) from verified areas.
+
+    The grid has 'gridsize' cells on its largest side.
+    """
+
+    # Edges of each freguesia (outer and inner rings)
+    areas = []
+    for adminid in admins.iterAdmins():
+        if admins.getLevel(adminid) != 8:
+            continue
+        codes = []
+        parentid = adminid
+        while parentid is not None and len(codes) < 3:
+            codes.append(admins.getCode(parentid))
+            parentid = admins.getParent(parentid)
+        codes.extend([ "" ] * (3 - len(codes)))
+        edges = []
+        for role in ("outer", "inner"):
+            for lineid in admins.getLines(adminid, role):
+                coords = shapeu.getLineCoords(lineid)
+                for i in xrange(1, len(coords)):
+                    edges.append(coords[i-1] + coords[i])
+        if edges:
+            areas.append( (codes, BandedEdges(edges)) )
+    if not areas:
+        return
+
+    xmin = min([ area.xmin for areacodes, area in areas ])
+    xmax = max([ area.xmax for areacodes, area in areas ])
+    ymin = min([ area.ymin for areacodes, area in areas ])
+    ymax = max([ area.ymax for areacodes, area in areas ])
+    cellsize = max(xmax - xmin, ymax - ymin) / gridsize
+    if cellsize <= 0.0:
+        cellsize = 1.0e-3
+    nx = int((xmax - xmin) / cellsize) + 1
+    ny = int((ymax - ymin) / cellsize) + 1
+
+    # Areas with an edge in each cell
+    cells = {}
+    for num, (areacodes, area) in enumerate(areas):
+        for x1, y1, x2, y2 in area.edges:
+            keys = gridcells( ((x1 - xmin, y1 - ymin),
+                               (x2 - xmin, y2 - ymin)), cellsize )
+            if keys is None:
+                i1 = int((min(x1, x2) - xmin) / cellsize)
+                i2 = int((max(x1, x2) - xmin) / cellsize)
+                j1 = int((min(y1, y2) - ymin) / cellsize)
+                j2 = int((max(y1, y2) - ymin) / cellsize)
+                keys = [ (i, j) for i in xrange(i1, i2+1)
+                                for j in xrange(j1, j2+1) ]
+            for key in keys:
+                candidates = cells.setdefault(key, [])
+                if not candidates or candidates[-1] != num:
+                    candidates.append(num)
+
+    # Cells without edge are in one area (or none), the same as the
+    # previous cell in the row if there is no edge between them
+    celltable = []
+    candtable = []
+    for j in xrange(ny):
+        current = None
+        for i in xrange(nx):
+            candidates = cells.get( (i, j) )
+            if candidates:
+                celltable.append( (len(candtable), len(candidates)) )
+                candtable.extend(candidates)
+                current = None
+                continue
+            if current is None:
+                lon = xmin + (i + 0.5) * cellsize
+                lat = ymin + (j + 0.5) * cellsize
+                current = -1
+                for num, (areacodes, area) in enumerate(areas):
+                    if area.contains(lon, lat):
+                        current = num
+                        break
+            celltable.append( (current, 0) )
+
+    # Write everything
+    nbband = sum([ len(area.bands) for areacodes, area in areas ])
+    nbedge = sum([ len(band) for areacodes, area in areas
+                               for band in area.bands ])
+    f = open(filename, "wb")
+    f.write(HEADER.pack(MAGIC, xmin, ymin, cellsize, cellsize, nx, ny,
+                        len(areas), len(candtable), nbband, nbedge))
+    firstband = 0
+    for areacodes, area in areas:
+        f.write(AREA.pack(areacodes[0], areacodes[1], areacodes[2],
+                          area.ymin, area.height, len(area.bands), firstband))
+        firstband += len(area.bands)
+    for cell in celltable:
+        f.write(CELL.pack(*cell))
+    for num in candtable:
+        f.write(INT.pack(num))
+    firstedge = 0
+    for areacodes, area in areas:
+        for band in area.bands:
+            f.write(BAND.pack(firstedge, len(band)))
+            firstedge += len(band)
+    for areacodes, area in areas:
+        for band in area.bands:
+            for edge in band:
+                f.write(EDGE.pack(*edge))
+    f.close()
+
+
+def edgescontains_many(edges, lons, lats):
+    """
+    Same test as edgescontains for NumPy arrays of points, 'edges' is
+    a (n, 4) array.
+    """
+
+    x1, y1, x2, y2 = edges[:,0], edges[:,1], edges[:,2], edges[:,3]
+    inside = numpy.zeros(len(lons), dtype=bool)
+    step = max(1, LOOKUPCHUNK // len(edges))
+    for start in xrange(0, len(lons), step):
+        lon = lons[start:start+step, numpy.newaxis]
+        lat = lats[start:start+step, numpy.newaxis]
+        vertex = ((lat == y1) & (lon == x1)) | ((lat == y2) & (lon == x2))
+        spans = ((lat > y1) & (lat <= y2)) | ((lat > y2) & (lat <= y1))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crossing = spans & (lon > x1 + (lat-y1) * (x2-x1) / (y2-y1))
+        inside[start:start+step] = (vertex.any(axis=1)
+                                    | (crossing.sum(axis=1) % 2 == 1))
+    return inside
+
+
+class LookupIndex:
+    """
+    Read only access to an index file, the file is memory-mapped and
+    only the cells and edges needed by a query are read, each cell and
+    band being decoded once.
+    """
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.xmin, self.ymin, self.cellx, self.celly, self.nx,
+         self.ny, nbarea, nbcand, nbband, nbedge) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a lookup index" % filename)
+        self.nbarea = nbarea
+        self.nbcand = nbcand
+        self.areapos = HEADER.size
+        self.cellpos = self.areapos + nbarea * AREA.size
+        self.candpos = self.cellpos + self.nx * self.ny * CELL.size
+        self.bandpos = self.candpos + nbcand * INT.size
+        self.edgepos = self.bandpos + nbband * BAND.size
+        self.areas = {}               # Area number -> decoded area entry
+        self.cells = {}               # Cell number -> (area, candidates)
+        self.bands = {}               # Band number -> list of edges
+        self.arrays = None            # NumPy views of the tables
+        self.bandarrays = {}          # Band number -> NumPy array of edges
+
+
+    def close(self):
+        self.arrays = None
+        self.bandarrays = {}
+        self.mm.close()
+        self.f.close()
+
+
+    def _area(self, num):
+        area = self.areas.get(num)
+        if area is None:
+            values = AREA.unpack_from(self.mm, self.areapos + num * AREA.size)
+            codes = tuple([ code.rstrip("\0") for code in values[:3] ])
+            area = (codes,) + values[3:]
+            self.areas[num] = area
+        return area
+
+
+    def _cell(self, cell):
+        """
+        Return (area, ()) for a cell inside one area (or -1), else
+        (-1, candidates).
+        """
+
+        entry = self.cells.get(cell)
+        if entry is None:
+            value, count = CELL.unpack_from(self.mm,
+                                            self.cellpos + cell * CELL.size)
+            if count:
+                entry = (-1, struct.unpack_from("<%di" % count, self.mm,
+                                                self.candpos + value*INT.size))
+            else:
+                entry = (value, ())
+            self.cells[cell] = entry
+        return entry
+
+
+    def _edges(self, band):
+        edges = self.bands.get(band)
+        if edges is None:
+            first, count = BAND.unpack_from(self.mm,
+                                            self.bandpos + band * BAND.size)
+            values = struct.unpack_from("<%dd" % (4 * count), self.mm,
+                                        self.edgepos + first * EDGE.size)
+            edges = [ values[i:i+4] for i in xrange(0, len(values), 4) ]
+            self.bands[band] = edges
+        return edges
+
+
+    def _contains(self, num, lon, lat):
+        codes, ymin, height, nbband, firstband = self._area(num)
+        band = firstband + bandnumber(lat, ymin, height, nbband)
+        return edgescontains(self._edges(band), lon, lat)
+
+
+    def lookup(self, lon, lat):
+        """
+        Return (DICOFRE, municipio, distrito or region) codes of the
+        freguesia containing the point or None.
+        """
+
+        i = int(math.floor((lon - self.xmin) / self.cellx))
+        j = int(math.floor((lat - self.ymin) / self.celly))
+        if i < 0 or j < 0 or i >= self.nx or j >= self.ny:
+            return None
+        area, candidates = self._cell(j*self.nx + i)
+        for num in candidates:
+            if self._contains(num, lon, lat):
+                return self._area(num)[0]
+        if area < 0:
+            return None
+        return self._area(area)[0]
+
+
+    def _numpy_arrays(self):
+        """
+        NumPy views of the area, cell and candidate tables (no copy).
+        """
+
+        if self.arrays is None:
+            areatype = numpy.dtype([ ("codes", "S18"), ("ymin", "<f8"),
+                                     ("height", "<f8"), ("nbband", "<i4"),
+                                     ("first", "<i4") ])
+            areas = numpy.frombuffer(self.mm, dtype=areatype,
+                                     count=self.nbarea, offset=self.areapos)
+            cells = numpy.frombuffer(self.mm, dtype="<i4",
+                                     count=2 * self.nx * self.ny,
+                                     offset=self.cellpos).reshape(-1, 2)
+            candidates = numpy.frombuffer(self.mm, dtype="<i4",
+                                          count=self.nbcand,
+                                          offset=self.candpos)
+            self.arrays = (areas, cells, candidates)
+        return self.arrays
+
+
+    def _numpy_edges(self, band):
+        edges = self.bandarrays.get(band)
+        if edges is None:
+            first, count = BAND.unpack_from(self.mm,
+                                            self.bandpos + band * BAND.size)
+            edges = numpy.frombuffer(self.mm, dtype="<f8", count=4 * count,
+                                     offset=self.edgepos + first * EDGE.size)
+            edges = edges.reshape(-1, 4)
+            self.bandarrays[band] = edges
+        return edges
+
+
+    def _numpy_contains(self, nums, lons, lats):
+        """
+        Test each point against its area, points are grouped by band.
+        """
+
+        areas = self._numpy_arrays()[0][nums]
+        band = numpy.clip((lats - areas["ymin"]) / areas["height"],
+                          0, areas["nbband"] - 1)
+        band = areas["first"] + band.astype(numpy.int32)
+        inside = numpy.zeros(len(nums), dtype=bool)
+        order = numpy.argsort(band, kind="mergesort")
+        bands, starts = numpy.unique(band[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        for band, start, end in zip(bands.tolist(), starts.tolist(),
+                                    ends.tolist()):
+            edges = self._numpy_edges(band)
+            if len(edges):
+                points = order[start:end]
+                inside[points] = edgescontains_many(edges, lons[points],
+                                                    lats[points])
+        return inside
+
+
+    def _numpy_lookup(self, lons, lats):
+        """
+        Return an array of area numbers (-1 outside) for the points.
+        """
+
+        areas, cells, candidates = self._numpy_arrays()
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        result = numpy.empty(len(lons), dtype=numpy.int32)
+        result.fill(-1)
+        i = numpy.floor((lons - self.xmin) / self.cellx)
+        j = numpy.floor((lats - self.ymin) / self.celly)
+        points = numpy.nonzero((i >= 0) & (j >= 0)
+                               & (i < self.nx) & (j < self.ny))[0]
+        cell = (j[points] * self.nx + i[points]).astype(numpy.intp)
+        value, count = cells[cell, 0], cells[cell, 1]
+        single = count == 0
+        result[points[single]] = value[single]
+
+        # Candidates are tried in order, the first containing the point wins
+        points, value, count = points[~single], value[~single], count[~single]
+        k = 0
+        while len(points):
+            nums = candidates[value + k]
+            found = self._numpy_contains(nums, lons[points], lats[points])
+            result[points[found]] = nums[found]
+            k += 1
+            left = ~found & (count > k)
+            points, value, count = points[left], value[left], count[left]
+        return result
+
+
+    def lookupMany(self, lons, lats):
+        """
+        Lookup a batch of points given by 2 sequences (lists, arrays)
+        of longitudes and latitudes, return a list of codes or None.
+        The batch is processed as arrays when NumPy is available.
+        """
+
+        if numpy is None:
+            return [ self.lookup(lon, lat) for lon, lat in zip(lons, lats) ]
+
+        result = self._numpy_lookup(lons, lats).tolist()
+        codes = dict([ (num, self._area(num)[0]) for num in set(result)
+                       if num >= 0 ])
+        codes[-1] = None
+        return [ codes[num] for num in result ]
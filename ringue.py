@@ -25,6 +25,12 @@
 Construct a multi-polygon from a bunch of lines.
 """
 
+import math
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from shapeu import intersect, posintersect, cmpslope
+
 class FindClosedRings:
     """
     Group lines in closed rings.
@@ -35,18 +41,51 @@ class FindClosedRings:
     """
 
     RING_CONNECT_BEGIN, RING_CONNECT_END, RING_CONNECT_FIRST = range(3)
+    GROWGRID = 64          # Grid cells on largest side of all lines extent
 
-    def __init__(self, backend, lines):
+    def __init__(self, backend, lines, ringcache=None, linecache=None,
+                 checkgrowing=False, maxbacktrack=None, maxtime=None):
         """
         Construct rings for a multipolygon from the list of unordered lines.
         The 'backend' must provide the following methods :
         - getLineEnds(lineid) = return first and last point in line
         - getLineCoords(lineid) = return all points in line
         - isRingValid(points) = is ordered list of points a valid ring
+        and optionally :
+        - getLineExtent(lineid) = return bounding box of line
+        - getExtentLines(lineids) = return bounding box of many lines
+        - getLinesEndsCoords(lineids) = return dictionary with for each
+          existing line ((first point, last point), all points in line)
+          replacing many getLineEnds/getLineCoords with only one call
+
+        A 'ringcache' (see RingCache) can be shared by several instances
+        to avoid checking again the validity of an already seen ring.
+        Coordinates of lines are kept in a 'linecache' (see LineCache),
+        by default one per instance.
+        With 'checkgrowing' a ring is rejected as soon as a new line makes
+        it self-intersecting or self-touching (same as isRingValid from
+        ShapeUtil), without waiting for the ring to be closed.
+        Backtracking stops after 'maxbacktrack' events or 'maxtime'
+        seconds, rings not closed at this point are discarded.
+
+        Counters are kept for the caller (see stats).
         """
 
         self.backend = backend
+        self.ringcache = ringcache
+        if linecache is None:
+            linecache = LineCache(backend)
+        self.linecache = linecache
+        self.checkgrowing = checkgrowing
+        self.maxbacktrack = maxbacktrack
+        self.maxtime = maxtime
+        self.nbrbacktrack = 0
+        self.nbrvalidcheck = 0
+        self.nbrgeometry = 0
+        self.overbudget = False
+        self.starttime = time.time()
         self.findclosedrings(lines)
+        self.elapsed = time.time() - self.starttime
 
 
     def findclosedrings(self, lines):
@@ -54,23 +93,43 @@ class FindClosedRings:
         Group lines into rings.
         """
 
+        self.read_lines(lines)
+        self.assemble_rings()
+        return
+
+
+    def read_lines(self, lines):
+        """
+        Read both ends of each line and reset state for building rings.
+        """
+
         self.lines = list(lines)
         self.linedone = [ False ] * len(lines)
         self.lineends = []                    # End point ID for each line
 
         # State for building rings : indice of lines + association direction
-        self.lineconnect = []
+        self.reset_rings()
 
         # Event in lineconnect to go when backtracking
         self.backstack = []
 
         # Keep state for unclosed ring (when backtracking have failed)
         self.discardconnect = []
+        self.discardstart = []
         self.discardends = []
 
+        if hasattr(self.backend, 'getLinesEndsCoords'):
+            # Read all lines at once, keep coordinates for later use
+            batch = self.backend.getLinesEndsCoords(self.lines)
+            for lineid, (points, coords) in batch.iteritems():
+                self.linecache.add(lineid, coords)
+            getlineends = lambda lineid: batch.get(lineid, (None,))[0]
+        else:
+            getlineends = self.backend.getLineEnds
+
         for lineid in lines:
             # Store start/end node of each line
-            points = self.backend.getLineEnds(lineid)
+            points = getlineends(lineid)
             if not points:
                 # Discard line if not exists
                 self.lines.remove(lineid)
@@ -78,14 +137,36 @@ class FindClosedRings:
             else:
                 self.lineends.extend(points)
 
+        # Point ID -> ordered list of indice in lineends
+        self.pointends = {}
+        for ind, pointid in enumerate(self.lineends):
+            self.pointends.setdefault(pointid, []).append(ind)
+
+
+    def reset_rings(self):
+        """
+        Forget all rings built.
+        """
+
+        self.lineconnect = []
+        self.ringstart = []                   # Indice of each ring start
+        self.growrings = []                   # Geometry index of each ring
+        self.growcellsize = None              # Grid size of these indexes
+        self.growundo = []                    # Index update for lineconnect
+
+
+    def assemble_rings(self):
+        """
+        Build all rings, backtracking on invalid rings.
+        """
+
         # Create one ring at a time until no more lines left
         self.newring = True
         while True:
             if self.assemble_ring():
                 if self.ringend1 == self.ringend2:
                     # Ring is closed, get geometry and check validity
-                    points = self.getGeometryRing()
-                    if self.backend.isRingValid(points):
+                    if self.isRingValid():
                         # Even if the ring is valid, do not save the geometry
                         # we will backtrack and build another ring association
                         # if the whole multipolygon is invalid
@@ -93,7 +174,6 @@ class FindClosedRings:
                         continue
             else:
                 # No more ring, all rings must form a valid multipolygon
-                # TODO: add check all rings without intersect
                 self.group_ring()
                 break
 
@@ -102,7 +182,23 @@ class FindClosedRings:
             if not self.backtrack():
                 self.discard_ring()
 
-        return
+
+    def isRingValid(self, ringnum=-1):
+        """
+        Check validity of a closed ring (reuse result from the cache).
+        """
+
+        if self.ringcache is None:
+            self.nbrvalidcheck += 1
+            return self.backend.isRingValid(self.getGeometryRing(ringnum))
+
+        lines = self.getLineRing(ringnum)
+        valid = self.ringcache.get(lines)
+        if valid is None:
+            self.nbrvalidcheck += 1
+            valid = self.backend.isRingValid(self.getGeometryRing(ringnum))
+            self.ringcache.add(lines, valid)
+        return valid
 
 
     def start_new_ring(self):
@@ -120,12 +216,16 @@ class FindClosedRings:
         # Consume line
         self.linedone[ind] = True
         ind = ind * 2
+        self.ringstart.append(len(self.lineconnect))
         self.lineconnect.append( (ind, self.RING_CONNECT_FIRST) )
 
         # Ring opened, keep track of currently unconnected point ID
         self.ringend1 = self.lineends[ind]
         self.ringend2 = self.lineends[ind + 1]
         self.newring = False
+        if self.checkgrowing:
+            # A self-intersecting line is left to the ring validity check
+            self._grow_ring(ind, self.RING_CONNECT_FIRST)
         return True
 
 
@@ -146,16 +246,12 @@ class FindClosedRings:
         while self.ringend1 != self.ringend2:
             # Find first index of a line connecting with ring
             dirconnect = []
-            try:
-                dirconnect.append( (self.lineends.index(self.ringend2, ind),
-                                    self.RING_CONNECT_END) )
-            except ValueError:
-                pass
-            try:
-                dirconnect.append( (self.lineends.index(self.ringend1, ind),
-                                    self.RING_CONNECT_BEGIN) )
-            except ValueError:
-                pass
+            nextind = self._find_lineend(self.ringend2, ind)
+            if nextind is not None:
+                dirconnect.append( (nextind, self.RING_CONNECT_END) )
+            nextind = self._find_lineend(self.ringend1, ind)
+            if nextind is not None:
+                dirconnect.append( (nextind, self.RING_CONNECT_BEGIN) )
 
             if not dirconnect:
                 # Assembling finished, ring is not closed
@@ -180,14 +276,165 @@ class FindClosedRings:
                 self.ringend1 = self.lineends[ind ^ 1]
 
             # Stack possible backtrack point
-            if self.lineends.count(self.lineends[ind]) > 2:
+            if len(self.pointends[self.lineends[ind]]) > 2:
                 self.backstack.append(len(self.lineconnect)-1)
 
+            if self.checkgrowing and not self._grow_ring(ind, dirjonction):
+                # Ring cannot be valid with this line, backtrack now
+                return True
+
             # To get next piece
             ind = 0
         return True
 
 
+    def _find_lineend(self, pointid, ind):
+        """
+        Return first indice in lineends >= 'ind' for 'pointid' or None.
+        """
+
+        indices = self.pointends.get(pointid)
+        if indices is None:
+            return None
+        pos = bisect_left(indices, ind)
+        if pos < len(indices):
+            return indices[pos]
+        return None
+
+
+    def _grow_ring(self, ind, dirjonction):
+        """
+        Add the line connected by line end 'ind' to the geometry index
+        of the current ring.
+
+        Return False if a point of the line is already in the ring or
+        a segment of the line intersects the ring.
+        """
+
+        if dirjonction == self.RING_CONNECT_FIRST \
+           and self.ringend1 == self.ringend2:
+            # Closed line (i.e. chain of LineChains) is a ring on its own,
+            # no line will be connected to it
+            self.growrings.append( ({}, [], {}, self.growcellsize) )
+            self.growundo.append( ([], []) )
+            return True
+
+        coords = self.linecache.getLineCoords(self.lines[int(ind/2)])
+        if ind & 1:
+            # Start with the point connecting the ring
+            coords.reverse()
+        if dirjonction == self.RING_CONNECT_FIRST:
+            # New ring, same grid for all rings of the lines
+            if self.growcellsize is None:
+                self.growcellsize = self._grow_cellsize(coords)
+            self.growrings.append( ({}, [], {}, self.growcellsize) )
+            newpoints = coords
+        else:
+            newpoints = coords[1:]
+        cells, bigsegs, points, cellsize = self.growrings[-1]
+        closed = self.ringend1 == self.ringend2
+
+        # Check new points and segments, only closing point can be a
+        # duplicate (last point of line)
+        valid = True
+        for i, coord in enumerate(newpoints):
+            if coord in points and not (closed and i == len(newpoints)-1):
+                valid = False
+                break
+        segments = [ (coords[i-1], coords[i]) for i in xrange(1, len(coords)) ]
+        for seg in segments:
+            if not valid:
+                break
+            for other in self._iter_cells(seg, cells, bigsegs, cellsize):
+                if intersect(seg[0], seg[1], other[0], other[1]):
+                    valid = False
+                    break
+
+        # Keep track of what's added for backtracking
+        if valid:
+            added = []
+            for seg in segments:
+                keys = gridcells(seg, cellsize)
+                if keys is None:
+                    bigsegs.append(seg)
+                else:
+                    for key in keys:
+                        cells.setdefault(key, []).append(seg)
+                added.append( (seg, keys) )
+            for coord in newpoints:
+                points[coord] = points.get(coord, 0) + 1
+            self.growundo.append( (added, newpoints) )
+        else:
+            self.growundo.append( ([], []) )
+        return valid
+
+
+    def _grow_cellsize(self, coords):
+        """
+        Return grid size of the geometry index of growing rings, from the
+        extent of all lines (or the line 'coords' if the backend does not
+        give extents).
+        """
+
+        if hasattr(self.backend, 'getExtentLines'):
+            bbox = self.backend.getExtentLines(self.lines)
+        elif hasattr(self.backend, 'getLineExtent'):
+            extents = [ self.backend.getLineExtent(lineid)
+                        for lineid in self.lines ]
+            bbox = ( min([ extent[0] for extent in extents ]),
+                     max([ extent[1] for extent in extents ]),
+                     min([ extent[2] for extent in extents ]),
+                     max([ extent[3] for extent in extents ]) )
+        else:
+            bbox = extentcoords(coords)
+        xmin, xmax, ymin, ymax = bbox
+        cellsize = max(xmax - xmin, ymax - ymin) / self.GROWGRID
+        if cellsize <= 0.0:
+            cellsize = 1.0e-3
+        return cellsize
+
+
+    def _shrink_ring(self, dirjonction):
+        """
+        Remove last line added in the geometry index (see _grow_ring).
+        """
+
+        added, newpoints = self.growundo.pop()
+        if dirjonction == self.RING_CONNECT_FIRST:
+            self.growrings.pop()
+            return
+        cells, bigsegs, points, cellsize = self.growrings[-1]
+        for seg, keys in reversed(added):
+            if keys is None:
+                bigsegs.pop()
+            else:
+                for key in keys:
+                    cells[key].pop()
+        for coord in newpoints:
+            points[coord] -= 1
+            if not points[coord]:
+                del points[coord]
+
+
+    def _iter_cells(self, seg, cells, bigsegs, cellsize):
+        """
+        Iterate on segments of the ring possibly intersecting 'seg'.
+        """
+
+        for other in bigsegs:
+            yield other
+        keys = gridcells(seg, cellsize)
+        if keys is None:
+            # Big segment compared with all
+            for segs in cells.itervalues():
+                for other in segs:
+                    yield other
+        else:
+            for key in keys:
+                for other in cells.get(key, ()):
+                    yield other
+
+
     def backtrack(self):
         """
         Rollback up to the next backtrack event.
@@ -198,13 +445,20 @@ class FindClosedRings:
         if not self.backstack:
             # No more backtrack
             return False
+        if self.overbudget or self._check_budget():
+            # Give up, the caller discards the current ring
+            return False
 
+        self.nbrbacktrack += 1
         goback = self.backstack.pop()
         while len(self.lineconnect) > goback:
             # Restore ring status and unconsume line
             ind, dirjonction = self.lineconnect.pop()
             self.linedone[int(ind/2)] = False
+            if self.checkgrowing:
+                self._shrink_ring(dirjonction)
             if dirjonction == self.RING_CONNECT_FIRST:
+                self.ringstart.pop()
                 self.newring = True
             elif dirjonction == self.RING_CONNECT_END:
                 self.ringend2 = self.lineends[ind]
@@ -218,23 +472,35 @@ class FindClosedRings:
         return True
 
 
+    def _check_budget(self):
+        """
+        Return True (and remember it) if backtracking must stop.
+        """
+
+        if self.maxbacktrack is not None \
+           and self.nbrbacktrack >= self.maxbacktrack:
+            self.overbudget = True
+        elif self.maxtime is not None \
+             and time.time() - self.starttime >= self.maxtime:
+            self.overbudget = True
+        return self.overbudget
+
+
     def discard_ring(self):
         """
         Discard lines of a malformed ring.
         """
 
-        lines = []
-        ind = len(self.lineconnect)
-        while ind > 0:
-            # Search to remove up to the beginning of current ring
-            ind -= 1
-            line, dirjonction = self.lineconnect[ind]
-            if dirjonction == self.RING_CONNECT_FIRST:
-                break
+        # Remove up to the beginning of current ring
+        ind = self.ringstart.pop()
 
         # Remove from backtrack but keep line as consumed
+        self.discardstart.append(len(self.discardconnect))
         self.discardconnect.extend(self.lineconnect[ind:])
         del self.lineconnect[ind:]
+        if self.checkgrowing:
+            self.growrings.pop()
+            del self.growundo[ind:]
         self.backstack = filter(lambda x: x < ind, self.backstack)
         self.discardends.append( (self.ringend1, self.ringend2) )
         self.newring = True
@@ -251,6 +517,7 @@ class FindClosedRings:
 
 
     def _build_geometry(self, ringnum=-1, usediscard=False):
+        self.nbrgeometry += 1
         if usediscard:
             lineconnect = self.discardconnect
         else:
@@ -259,7 +526,7 @@ class FindClosedRings:
         start, end = self._getconnect_ring(ringnum, usediscard)
         points = []
         for ind, dirjonction in lineconnect[start:end]:
-            lstpnt = self.backend.getLineCoords(self.lines[int(ind/2)])
+            lstpnt = self.linecache.getLineCoords(self.lines[int(ind/2)])
             if dirjonction == self.RING_CONNECT_FIRST:
                 points = lstpnt
             elif dirjonction == self.RING_CONNECT_BEGIN:
@@ -302,13 +569,68 @@ class FindClosedRings:
         - last point ID
 
         For an open ring first_point != last_point, for a closed but
-        still invalid ring (self-intersecting) first_point = last_point.
+        still invalid ring (self-intersecting or crossing another ring,
+        see iterRingCrossing) first_point = last_point.
         """
 
         for ringnum, (pnt1,pnt2) in enumerate(self.discardends):
             yield (ringnum, pnt1, pnt2)
 
 
+    def iterRingCrossing(self):
+        """
+        Iterate on rings discarded because they cross each other.
+
+        Return for each pair of crossing rings :
+        - first ring number (see iterRingDiscarded)
+        - second ring number
+        - coordinates of one intersection point
+        """
+
+        return iter(self.crossrings)
+
+
+    def _discard_crossing(self, crossing, touching, coordrings):
+        """
+        Move closed rings crossing other rings to the discarded rings.
+
+        Return coordinates of remaining rings and touching pairs of rings
+        with the new ring numbers.
+        """
+
+        discard = set()
+        for pair in crossing:
+            discard.update(pair)
+
+        lineconnect = []
+        ringstart = []
+        coords = []
+        renum = {}
+        for ring in xrange(self.nbrRing()):
+            start, end = self._getconnect_ring(ring)
+            if ring in discard:
+                # Closed ring, same ends as a self-intersecting ring
+                renum[ring] = len(self.discardstart)
+                pointid = self.lineends[self.lineconnect[start][0]]
+                self.discardstart.append(len(self.discardconnect))
+                self.discardconnect.extend(self.lineconnect[start:end])
+                self.discardends.append( (pointid, pointid) )
+            else:
+                renum[ring] = len(ringstart)
+                ringstart.append(len(lineconnect))
+                lineconnect.extend(self.lineconnect[start:end])
+                coords.append(coordrings[ring])
+        self.lineconnect = lineconnect
+        self.ringstart = ringstart
+
+        for (ring1, ring2), coord in sorted(crossing.iteritems()):
+            self.crossrings.append( (renum[ring1], renum[ring2], coord) )
+        touching = set([ (renum[ring1], renum[ring2])
+                         for ring1, ring2 in touching
+                         if ring1 not in discard and ring2 not in discard ])
+        return coords, touching
+
+
     def getLineDiscarded(self, ringnum=-1):
         """
         Return unordered list of lines ID in a not well formed ring.
@@ -336,21 +658,37 @@ class FindClosedRings:
         Return number of rings.
         """
 
-        return len( [ i for i in self.lineconnect
-                      if i[1] == self.RING_CONNECT_FIRST ])
+        return len(self.ringstart)
+
+
+    def stats(self):
+        """
+        Return counters of the rings assembly as a dictionary.
+        """
+
+        return { 'lines': len(self.lines),
+                 'rings': self.nbrRing(),
+                 'discarded': len(self.discardstart),
+                 'backtracks': self.nbrbacktrack,
+                 'validchecks': self.nbrvalidcheck,
+                 'geometries': self.nbrgeometry,
+                 'elapsed': self.elapsed,
+                 'overbudget': self.overbudget }
 
 
     def _getconnect_ring(self, ringnum, usediscard=False):
         if usediscard:
             lineconnect = self.discardconnect
+            ring_pos = self.discardstart
         else:
             lineconnect = self.lineconnect
-        ring_pos = [ i for i, j in enumerate(lineconnect)
-                      if j[1] == self.RING_CONNECT_FIRST ]
+            ring_pos = self.ringstart
         start = ring_pos[ringnum]
-        ring_pos[0] = len(lineconnect)
         ringnum = (ringnum+1) % len(ring_pos)
-        end = ring_pos[ringnum]
+        if ringnum:
+            end = ring_pos[ringnum]
+        else:
+            end = len(lineconnect)
         return (start, end)
 
 
@@ -369,19 +707,23 @@ class FindClosedRings:
         Return bounding box of all lines not in a ring.
         """
 
-        xmin = []
-        xmax = []
-        ymin = []
-        ymax = []
         lines = [ self.lines[int(ind/2)]
                   for ind, dirjonction in self.discardconnect ]
-        for lineid in lines:
-            coords = self.backend.getLineCoords(lineid)
-            xmin.append(min(coords, key=lambda a: a[0])[0])
-            ymin.append(min(coords, key=lambda a: a[1])[1])
-            xmax.append(max(coords, key=lambda a: a[0])[0])
-            ymax.append(max(coords, key=lambda a: a[1])[1])
-        return ( min(xmin), max(xmax), min(ymin), max(ymax) )
+        return self._extent_lines(lines)
+
+
+    def _extent_lines(self, lines):
+        if hasattr(self.backend, 'getLineExtent'):
+            # Precomputed by the backend, no need to read coordinates
+            extents = [ self.backend.getLineExtent(lineid)
+                        for lineid in lines ]
+        else:
+            extents = [ extentcoords(self.linecache.getLineCoords(lineid))
+                        for lineid in lines ]
+        return ( min([ bbox[0] for bbox in extents ]),
+                 max([ bbox[1] for bbox in extents ]),
+                 min([ bbox[2] for bbox in extents ]),
+                 max([ bbox[3] for bbox in extents ]) )
 
 
     def getExtentRing(self, ringnum):
@@ -400,51 +742,64 @@ class FindClosedRings:
         """
 
         self.polygonring = {}
+        self.crossrings = []
+        coordrings = [ self.getGeometryRing(ring)
+                       for ring in xrange(self.nbrRing()) ]
+
+        # Rings must not cross each other, crossing rings are discarded
+        crossing, touching = ringsintersection(coordrings)
+        if crossing:
+            coordrings, touching = self._discard_crossing(crossing, touching,
+                                                          coordrings)
         nbr = self.nbrRing()
-        coordrings = []
-        self.bboxrings = []
 
         # List relationship for a ring
         # - if N is contained by A, B : containedby[N] = [ A, B, ... ]
         # - if N is not contained by other ring : containedby[N] = []
         containedby = [ [] for i in xrange(nbr) ]
 
+        self.bboxrings = []
         for ring in xrange(nbr):
-            # Get coordinates of each ring
-            coords = self.getGeometryRing(ring)
-            coordrings.append(coords)
-
-            # Ring bounding box
-            xmin = min(coords, key=lambda a: a[0])[0]
-            ymin = min(coords, key=lambda a: a[1])[1]
-            xmax = max(coords, key=lambda a: a[0])[0]
-            ymax = max(coords, key=lambda a: a[1])[1]
-            self.bboxrings.append( (xmin, xmax, ymin, ymax) )
-
-        # Compare each ring and cache result in ring contained by ring list
-        for i in xrange(nbr):
-            for j in xrange(nbr):
+            if hasattr(self.backend, 'getLineExtent'):
+                # Ring bounding box from precomputed line extents
+                lines = self.getLineRing(ring)
+                self.bboxrings.append(self._extent_lines(lines))
+            else:
+                self.bboxrings.append(extentcoords(coordrings[ring]))
+
+        # Compare each ring only with rings with a bounding box containing
+        # its own bounding box and a greater area, cache result in ring
+        # contained by ring list (and the reverse list)
+        contains = [ [] for i in xrange(nbr) ]
+        arearings = [ abs(ringarea(coords)) for coords in coordrings ]
+        preparedrings = [ None ] * nbr
+        boxindex = BoxIndex(self.bboxrings)
+        for j in xrange(nbr):
+            for i in sorted(boxindex.iterContains(self.bboxrings[j])):
                 if i == j:
                     continue
-
-                # Check bounding box ring 1 contains bounding box ring 2
-                xmin1, xmax1, ymin1, ymax1 = self.bboxrings[i]
-                xmin2, xmax2, ymin2, ymax2 = self.bboxrings[j]
-                if (xmin2 < xmin1 or xmax2 > xmax1
-                  or ymin2 < ymin1 or ymax2 > ymax1):
+                if arearings[i] < arearings[j]:
                     continue
-
-                if ringcontains(coordrings[i], coordrings[j]):
+                if preparedrings[i] is None:
+                    preparedrings[i] = PreparedRing(coordrings[i])
+                # Without any contact one point of the ring is enough
+                cannotcross = (min(i, j), max(i, j)) not in touching
+                if preparedrings[i].containsRing(coordrings[j], cannotcross):
                     containedby[j].append(i)
+                    contains[i].append(j)
 
         # Group ring, find top most ring (parent) and its immediate child
-        ringstack = range(nbr)
-        while ringstack:
+        instack = set(xrange(nbr))
+        first = 0
+        while instack:
+            while first not in instack:
+                first += 1
+
             # Search (upward) outer ring (not contained by other ring)
-            outer = ringstack[0]
+            outer = first
             while containedby[outer]:
                 for ring in containedby[outer]:
-                    if ring in ringstack:
+                    if ring in instack:
                         outer = ring
                         break
                 else:
@@ -452,17 +807,766 @@ class FindClosedRings:
 
             # Outer ring is polygon on its own
             self.polygonring[outer] = []
-            ringstack.remove(outer)
+            instack.remove(outer)
 
             # Search and group its inner ring
-            for inner in ringstack[:]:
-                if outer in containedby[inner]:
-                    for ring in containedby[inner]:
-                        if ring in ringstack:
-                            break
-                    else:
-                        self.polygonring[outer].append(inner)
-                        ringstack.remove(inner)
+            for inner in contains[outer]:
+                if inner not in instack:
+                    continue
+                for ring in containedby[inner]:
+                    if ring in instack:
+                        break
+                else:
+                    self.polygonring[outer].append(inner)
+                    instack.remove(inner)
+
+
+class FindPlanarRings(FindClosedRings):
+    """
+    Group lines in closed rings walking around each node.
+
+    At each node the lines are sorted by angle and paired with their
+    neighbour, following pairs give rings touching but never crossing
+    each other in a time proportional to the number of lines.
+    The backtracking of FindClosedRings is only used when this fails
+    (open ring, crossing lines or no angle given by the backend).
+    """
+
+    def __init__(self, backend, lines, ringcache=None, linecache=None,
+                 checkgrowing=False, maxbacktrack=None, maxtime=None):
+        """
+        Same as FindClosedRings, the 'backend' must also provide :
+        - getLineEndSegments(lineid) = return first and last segment
+          in line, each segment starting at the end point of the line
+        """
+
+        self.planar = False
+        FindClosedRings.__init__(self, backend, lines, ringcache, linecache,
+                                 checkgrowing, maxbacktrack, maxtime)
+
+
+    def findclosedrings(self, lines):
+        """
+        Group lines into rings.
+        """
+
+        self.read_lines(lines)
+        if hasattr(self.backend, 'getLineEndSegments'):
+            self.planar = self.walk_rings()
+        if self.planar:
+            self.linedone = [ True ] * len(self.lines)
+            self.group_ring()
+        else:
+            self.reset_rings()
+            self.assemble_rings()
+        return
+
+
+    def walk_rings(self):
+        """
+        Build all rings, pairing lines around each node.
+
+        Return False if one ring is open or not valid.
+        """
+
+        # Pair each line end with the next one around the node
+        partner = [ None ] * len(self.lineends)
+        for pointid, indices in self.pointends.iteritems():
+            if len(indices) % 2:
+                return False
+            if len(indices) > 2:
+                indices = sorted(indices, key=self._angle_lineend)
+            for i in xrange(0, len(indices), 2):
+                partner[indices[i]] = indices[i+1]
+                partner[indices[i+1]] = indices[i]
+
+        # Follow lines, a line is entered by the line end 'ind' and
+        # leaved by the other end 'ind^1'
+        used = [ False ] * len(self.lines)
+        for start in xrange(0, len(self.lineends), 2):
+            if used[int(start/2)]:
+                continue
+            ind = start
+            trail = []
+            while not used[int(ind/2)]:
+                used[int(ind/2)] = True
+                trail.append(ind)
+                ind = partner[ind^1]
+
+            # Split trail in simple rings when a node is seen twice
+            stack = []
+            position = {}
+            for ind in trail:
+                pointid = self.lineends[ind]
+                if pointid in position:
+                    pos = position[pointid]
+                    ring = stack[pos:]
+                    del stack[pos:]
+                    for i in ring:
+                        del position[self.lineends[i]]
+                    if not self._add_ring(ring):
+                        return False
+                position[pointid] = len(stack)
+                stack.append(ind)
+            if not self._add_ring(stack):
+                return False
+        return True
+
+
+    def _angle_lineend(self, ind):
+        segments = self.backend.getLineEndSegments(self.lines[int(ind/2)])
+        (x1, y1), (x2, y2) = segments[ind & 1]
+        return math.atan2(y2-y1, x2-x1)
+
+
+    def _add_ring(self, ring):
+        """
+        Append ring (list of entering line end) to lineconnect.
+
+        Return False if ring is not valid.
+        """
+
+        if ring[0] & 1:
+            # First line must be in its own direction, reverse ring
+            ring = [ ind^1 for ind in reversed(ring) ]
+            ring = ring[-1:] + ring[:-1]
+        self.ringstart.append(len(self.lineconnect))
+        self.lineconnect.append( (ring[0], self.RING_CONNECT_FIRST) )
+        for ind in ring[1:]:
+            self.lineconnect.append( (ind, self.RING_CONNECT_END) )
+        return self.isRingValid()
+
+
+class LineChains:
+    """
+    Backend joining lines into chains for FindClosedRings.
+
+    The lines of an area (municipio, distrito) kept from a ring of one
+    of its parts (freguesia, municipio) are following each other in the
+    ring of the area, each run of these lines is given to FindClosedRings
+    as one line. A ring of a part kept whole is a closed chain and a
+    ring on its own, the search is left with the chains along the
+    boundaries not shared between parts. Other lines of the area are
+    chains of one line.
+
+    A chain ID is its position in getChains.
+    """
+
+    def __init__(self, backend, lines, rings, linecache=None):
+        """
+        Chains of 'lines' from the 'rings' (lists of lines ID) of the
+        parts of the area, the rings must be valid.
+        """
+
+        self.backend = backend
+        if linecache is None:
+            linecache = LineCache(backend)
+        self.linecache = linecache
+        self.chains = []              # Chain ID -> [ (lineid, reversed) ]
+        self.chainends = []           # Chain ID -> (first, last point ID)
+
+        lines = set(lines)
+        for ring in rings:
+            kept = [ lineid for lineid in ring if lineid in lines ]
+            lines.difference_update(kept)
+            self._add_chains(kept)
+        for lineid in sorted(lines):
+            self._add_chains([ lineid ])
+
+
+    def _add_chains(self, lines):
+        """
+        Join lines of a same ring, each point is the end of 2 lines
+        at most.
+        """
+
+        lineends = {}
+        nodes = {}
+        for lineid in lines:
+            points = self.backend.getLineEnds(lineid)
+            if not points:
+                continue
+            lineends[lineid] = points
+            for pointid in points:
+                nodes.setdefault(pointid, []).append(lineid)
+
+        # Follow lines both ways from each line not already in a chain
+        visited = set()
+        for lineid in lines:
+            if lineid not in lineends or lineid in visited:
+                continue
+            visited.add(lineid)
+            chain = deque([ (lineid, False) ])
+            first, last = lineends[lineid]
+            while first != last:
+                nextid = self._next_line(nodes, last, visited)
+                if nextid is None:
+                    break
+                pointid1, pointid2 = lineends[nextid]
+                if pointid1 == last:
+                    chain.append( (nextid, False) )
+                    last = pointid2
+                else:
+                    chain.append( (nextid, True) )
+                    last = pointid1
+            while first != last:
+                nextid = self._next_line(nodes, first, visited)
+                if nextid is None:
+                    break
+                pointid1, pointid2 = lineends[nextid]
+                if pointid2 == first:
+                    chain.appendleft( (nextid, False) )
+                    first = pointid1
+                else:
+                    chain.appendleft( (nextid, True) )
+                    first = pointid2
+            self.chains.append(list(chain))
+            self.chainends.append( (first, last) )
+
+
+    def _next_line(self, nodes, pointid, visited):
+        for lineid in nodes[pointid]:
+            if lineid not in visited:
+                visited.add(lineid)
+                return lineid
+        return None
+
+
+    def getChains(self):
+        """
+        Return list of chains ID.
+        """
+
+        return range(len(self.chains))
+
+
+    def getLines(self, chainids):
+        """
+        Return list of lines ID in chains.
+        """
+
+        return [ lineid for chainid in chainids
+                        for lineid, rev in self.chains[chainid] ]
+
+
+    def getLineEnds(self, chainid):
+        """
+        Return first and last point ID of a chain.
+        """
+
+        return self.chainends[chainid]
+
+
+    def getLineCoords(self, chainid):
+        """
+        Return all coordinates of a chain.
+        """
+
+        coords = []
+        for lineid, rev in self.chains[chainid]:
+            lstpnt = self.linecache.getLineCoords(lineid)
+            if rev:
+                lstpnt.reverse()
+            coords[-1:] = lstpnt
+        return coords
+
+
+    def getLineExtent(self, chainid):
+        """
+        Return bounding box of a chain.
+        """
+
+        return self.getExtentLines([ chainid ])
+
+
+    def getExtentLines(self, chainids):
+        """
+        Return bounding box of many chains.
+        """
+
+        lines = self.getLines(chainids)
+        if hasattr(self.backend, 'getExtentLines'):
+            return self.backend.getExtentLines(lines)
+        if hasattr(self.backend, 'getLineExtent'):
+            extents = [ self.backend.getLineExtent(lineid)
+                        for lineid in lines ]
+        else:
+            extents = [ extentcoords(self.linecache.getLineCoords(lineid))
+                        for lineid in lines ]
+        return ( min([ bbox[0] for bbox in extents ]),
+                 max([ bbox[1] for bbox in extents ]),
+                 min([ bbox[2] for bbox in extents ]),
+                 max([ bbox[3] for bbox in extents ]) )
+
+
+    def getLineEndSegments(self, chainid):
+        """
+        Return first and last segment of a chain, each segment starting
+        at the end point of the chain.
+        """
+
+        chain = self.chains[chainid]
+        if hasattr(self.backend, 'getLineEndSegments'):
+            lineid, rev = chain[0]
+            segment1 = self.backend.getLineEndSegments(lineid)[int(rev)]
+            lineid, rev = chain[-1]
+            segment2 = self.backend.getLineEndSegments(lineid)[int(not rev)]
+            return (segment1, segment2)
+        coords = self.getLineCoords(chainid)
+        return ( (coords[0], coords[1]), (coords[-1], coords[-2]) )
+
+
+    def isRingValid(self, points):
+        return self.backend.isRingValid(points)
+
+
+class ChainRingCache:
+    """
+    RingCache used with chains ID (see LineChains), rings are stored
+    by their lines so that they are the same at each admin level.
+    """
+
+    def __init__(self, chains, ringcache):
+        self.chains = chains
+        self.ringcache = ringcache
+
+
+    def get(self, chainids):
+        return self.ringcache.get(self.chains.getLines(chainids))
+
+
+    def add(self, chainids, valid):
+        self.ringcache.add(self.chains.getLines(chainids), valid)
+
+
+class RingCache:
+    """
+    Remember validity of closed rings.
+
+    A ring is identified by its set of lines, the same ring can be found
+    in several multipolygons (i.e. each admin level) and checked once.
+    """
+
+    def __init__(self):
+        self.rings = {}
+        self.added = []         # (lines, valid) stored since getAdded
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, lines):
+        """
+        Return validity of ring made of 'lines' or None if not known.
+        """
+
+        valid = self.rings.get(frozenset(lines))
+        if valid is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return valid
+
+
+    def add(self, lines, valid):
+        """
+        Store validity of ring made of 'lines'.
+        """
+
+        lines = frozenset(lines)
+        self.rings[lines] = valid
+        self.added.append( (lines, valid) )
+
+
+    def update(self, rings):
+        """
+        Store validity of rings checked by another cache (list of
+        (lines, valid) given by getAdded).
+        """
+
+        for lines, valid in rings:
+            self.rings[lines] = valid
+
+
+    def getAdded(self):
+        """
+        Return and forget list of (lines, valid) stored by add since the
+        last call.
+        """
+
+        added = self.added
+        self.added = []
+        return added
+
+
+    def hitrate(self):
+        """ Return percentage of lookup found in cache. """
+
+        if self.hits + self.misses == 0:
+            return 0.0
+        return 100.0 * self.hits / (self.hits + self.misses)
+
+
+class LineCache:
+    """
+    Remember coordinates of the most recently used lines.
+
+    Can be shared by several FindClosedRings with the same backend when
+    reading coordinates is expensive (i.e. a database backend).
+    """
+
+    def __init__(self, backend, size=4096):
+        self.backend = backend
+        self.size = size
+        self.lines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def getLineCoords(self, lineid):
+        """
+        Return a new list of all points in line.
+        """
+
+        coords = self.lines.pop(lineid, None)
+        if coords is None:
+            self.misses += 1
+            coords = self.backend.getLineCoords(lineid)
+            if len(self.lines) >= self.size:
+                # Forget least recently used line
+                self.lines.popitem(last=False)
+        else:
+            self.hits += 1
+        self.lines[lineid] = coords
+        return list(coords)
+
+
+    def add(self, lineid, coords):
+        """
+        Store coordinates of a line already read.
+        """
+
+        self.lines.pop(lineid, None)
+        if len(self.lines) >= self.size:
+            self.lines.popitem(last=False)
+        self.lines[lineid] = coords
+
+
+    def hitrate(self):
+        """ Return percentage of lookup found in cache. """
+
+        if self.hits + self.misses == 0:
+            return 0.0
+        return 100.0 * self.hits / (self.hits + self.misses)
+
+
+class BoxIndex:
+    """
+    Static R-tree of bounding boxes (xmin, xmax, ymin, ymax).
+
+    Built once with the Sort-Tile-Recursive packing, each box is
+    identified by its position in the list given to the constructor.
+    """
+
+    NODESIZE = 16
+
+    def __init__(self, boxes):
+        # Each node is (bounding box, list of child nodes), the leaf nodes
+        # have (bounding box, box number) as child nodes
+        nodes = [ (box, num) for num, box in enumerate(boxes) ]
+        nodes = self._pack(nodes)
+        self.depth = 0
+        while len(nodes) > self.NODESIZE:
+            nodes = self._pack(nodes)
+            self.depth += 1
+        self.root = nodes
+
+
+    def _pack(self, nodes):
+        """
+        Group nodes by NODESIZE, close nodes in the same group.
+        """
+
+        if not nodes:
+            return []
+        size = self.NODESIZE
+        nbgroup = int(math.ceil(len(nodes) / float(size)))
+        nbslice = int(math.ceil(math.sqrt(nbgroup)))
+        nodes = sorted(nodes, key=lambda a: a[0][0] + a[0][1])
+        packed = []
+        for i in xrange(0, len(nodes), nbslice * size):
+            vslice = sorted(nodes[i:i + nbslice * size],
+                            key=lambda a: a[0][2] + a[0][3])
+            for j in xrange(0, len(vslice), size):
+                group = vslice[j:j + size]
+                bbox = ( min([ node[0][0] for node in group ]),
+                         max([ node[0][1] for node in group ]),
+                         min([ node[0][2] for node in group ]),
+                         max([ node[0][3] for node in group ]) )
+                packed.append( (bbox, group) )
+        return packed
+
+
+    def iterContains(self, box):
+        """
+        Iterate on number of each box containing 'box'.
+        """
+
+        xmin, xmax, ymin, ymax = box
+        stack = [ (self.root, self.depth) ]
+        while stack:
+            nodes, depth = stack.pop()
+            for bbox, child in nodes:
+                if (xmin < bbox[0] or xmax > bbox[1]
+                  or ymin < bbox[2] or ymax > bbox[3]):
+                    continue
+                if depth < 0:
+                    yield child
+                else:
+                    stack.append( (child, depth-1) )
+
+
+class BandedEdges:
+    """
+    Edges (x1, y1, x2, y2) of rings grouped by latitude band for point
+    in polygon queries, a point is only compared with edges in its own
+    band.
+    """
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.xmin = min([ min(x1, x2) for x1, y1, x2, y2 in edges ])
+        self.xmax = max([ max(x1, x2) for x1, y1, x2, y2 in edges ])
+        self.ymin = min([ min(y1, y2) for x1, y1, x2, y2 in edges ])
+        self.ymax = max([ max(y1, y2) for x1, y1, x2, y2 in edges ])
+        nbband = int(math.sqrt(len(edges))) + 1
+        self.height = (self.ymax - self.ymin) / nbband
+        if self.height <= 0.0:
+            nbband = 1
+            self.height = 1.0
+        self.bands = [ [] for i in xrange(nbband) ]
+        for edge in edges:
+            x1, y1, x2, y2 = edge
+            for band in xrange(self._band(min(y1, y2)),
+                               self._band(max(y1, y2)) + 1):
+                self.bands[band].append(edge)
+
+
+    def _band(self, lat):
+        return bandnumber(lat, self.ymin, self.height, len(self.bands))
+
+
+    def contains(self, lon, lat):
+        """
+        Check if point is inside the rings (a point on a vertex is inside).
+        """
+
+        return edgescontains(self.bands[self._band(lat)], lon, lat)
+
+
+def bandnumber(lat, ymin, height, nbband):
+    """
+    Return latitude band of 'lat' (first or last band when outside).
+    """
+
+    band = int((lat - ymin) / height)
+    if band < 0:
+        return 0
+    if band >= nbband:
+        return nbband - 1
+    return band
+
+
+def edgescontains(edges, lon, lat):
+    """
+    Crossing number of a ray from the point (a point on a vertex is in).
+    """
+
+    flg = False
+    for x1, y1, x2, y2 in edges:
+        if (lat < y1 and lat < y2) or (lat > y1 and lat > y2):
+            continue
+        if (lat == y1 and lon == x1) or (lat == y2 and lon == x2):
+            # Consider ring touch as 'in'
+            return True
+        if (lat > y1 and lat <= y2) or (lat > y2 and lat <= y1):
+            if lon > x1 + (lat-y1) * (x2-x1) / (y2-y1):
+                flg = not flg
+    return flg
+
+
+class PreparedRing(BandedEdges):
+    """
+    Ring prepared for point in polygon queries.
+    """
+
+    def __init__(self, ring):
+        BandedEdges.__init__(self, [ ring[i-1] + ring[i]
+                                     for i in xrange(1, len(ring)) ])
+        self.ring = ring
+        self.vertices = None
+
+
+    def containsRing(self, ring, cannotcross=False):
+        """
+        Check if coordinates in 'ring' are contained in the ring.
+
+        If both rings 'cannotcross' only the first point of 'ring' not
+        touching the ring is checked.
+        """
+
+        if cannotcross:
+            if self.vertices is None:
+                self.vertices = set(self.ring)
+            for coord in ring:
+                if coord not in self.vertices:
+                    return self.contains(coord[0], coord[1])
+
+        for lon, lat in ring:
+            if not self.contains(lon, lat):
+                # At least 1 point out
+                return False
+        return True
+
+
+def gridcells(seg, cellsize):
+    """
+    Return list of grid cells covered by a segment or None if there
+    is too many cells.
+    """
+
+    (x1, y1), (x2, y2) = seg[:2]
+    i1 = int(math.floor(min(x1, x2) / cellsize))
+    i2 = int(math.floor(max(x1, x2) / cellsize))
+    j1 = int(math.floor(min(y1, y2) / cellsize))
+    j2 = int(math.floor(max(y1, y2) / cellsize))
+    if (i2-i1+1) * (j2-j1+1) > 64:
+        return None
+    return [ (i, j) for i in xrange(i1, i2+1) for j in xrange(j1, j2+1) ]
+
+
+def ringsintersection(rings):
+    """
+    Find rings crossing or touching each other.
+
+    Segments of all rings are stored in a grid, only segments sharing
+    a cell are compared (each pair once, in the cell of the lower corner
+    of their common bounding box).
+    Return (crossing, touching) : a dictionary with one intersection
+    point for each pair (ring1, ring2) of crossing rings and a set of
+    pairs of rings touching each other, with ring1 < ring2.
+    """
+
+    crossing = {}
+    touching = set()
+    if len(rings) < 2:
+        return crossing, touching
+
+    # Vertices shared by rings
+    vertices = {}
+    shared = {}
+    for num, ring in enumerate(rings):
+        for coord in ring:
+            other = vertices.setdefault(coord, num)
+            if other != num:
+                shared.setdefault(coord, set([other])).add(num)
+    for nums in shared.itervalues():
+        nums = sorted(nums)
+        for i in xrange(len(nums)):
+            for j in xrange(i+1, len(nums)):
+                touching.add( (nums[i], nums[j]) )
+    del vertices, shared
+
+    # Grid size for a few segments per cell
+    extents = [ extentcoords(ring) for ring in rings ]
+    xmin = min([ bbox[0] for bbox in extents ])
+    xmax = max([ bbox[1] for bbox in extents ])
+    ymin = min([ bbox[2] for bbox in extents ])
+    ymax = max([ bbox[3] for bbox in extents ])
+    nbseg = sum([ len(ring) - 1 for ring in rings ])
+    cellsize = max(xmax - xmin, ymax - ymin) / math.sqrt(max(nbseg, 1))
+    if cellsize <= 0.0:
+        cellsize = 1.0e-3
+
+    cells = {}
+    bigsegs = []
+    for num, ring in enumerate(rings):
+        for i in xrange(1, len(ring)):
+            seg = (ring[i-1], ring[i], num)
+            keys = gridcells(seg, cellsize)
+            if keys is None:
+                bigsegs.append(seg)
+            else:
+                for key in keys:
+                    cells.setdefault(key, []).append(seg)
+
+    def compare(seg1, seg2, key):
+        (a, b, ring1), (c, d, ring2) = seg1, seg2
+        if ring1 == ring2:
+            return
+        if ring1 > ring2:
+            ring1, ring2 = ring2, ring1
+        if (ring1, ring2) in crossing:
+            return
+        x = max(min(a[0], b[0]), min(c[0], d[0]))
+        y = max(min(a[1], b[1]), min(c[1], d[1]))
+        if x > min(max(a[0], b[0]), max(c[0], d[0])) \
+           or y > min(max(a[1], b[1]), max(c[1], d[1])):
+            # Disjoint bounding boxes
+            return
+        if key is not None and key != (int(math.floor(x / cellsize)),
+                                       int(math.floor(y / cellsize))):
+            # Compared in another cell
+            return
+        if intersect(a, b, c, d):
+            crossing[(ring1, ring2)] = posintersect(a, b, c, d)
+        elif (onsegment(a, c, d) or onsegment(b, c, d)
+              or onsegment(c, a, b) or onsegment(d, a, b)):
+            touching.add( (ring1, ring2) )
+
+    for key, segs in cells.iteritems():
+        for i in xrange(len(segs)):
+            for j in xrange(i+1, len(segs)):
+                compare(segs[i], segs[j], key)
+            for seg in bigsegs:
+                compare(segs[i], seg, key)
+    for i in xrange(len(bigsegs)):
+        for j in xrange(i+1, len(bigsegs)):
+            compare(bigsegs[i], bigsegs[j], None)
+    return crossing, touching
+
+
+def onsegment(p, a, b):
+    """
+    Check if point P is on segment AB.
+    """
+
+    if cmpslope(a, p, b):
+        return False
+    return (min(a[0], b[0]) <= p[0] <= max(a[0], b[0])
+            and min(a[1], b[1]) <= p[1] <= max(a[1], b[1]))
+
+
+def extentcoords(coords):
+    """
+    Return bounding box (xmin, xmax, ymin, ymax) of a list of coordinates.
+    """
+
+    xmin = min(coords, key=lambda a: a[0])[0]
+    ymin = min(coords, key=lambda a: a[1])[1]
+    xmax = max(coords, key=lambda a: a[0])[0]
+    ymax = max(coords, key=lambda a: a[1])[1]
+    return (xmin, xmax, ymin, ymax)
+
+
+def ringarea(ring):
+    """
+    Return signed area of a closed ring (in square degrees).
+    """
+
+    area = 0.0
+    for i in xrange(1, len(ring)):
+        area += ring[i-1][0] * ring[i][1] - ring[i][0] * ring[i-1][1]
+    return area / 2.0
 
 
 def ringcontains(ring1, ring2):
@@ -470,21 +1574,4 @@ def ringcontains(ring1, ring2):
     Check if coordinates in ring2 are contained in ring1.
     """
 
-    for lon, lat in ring2:
-        flg = False
-        for i in xrange(1, len(ring1)):
-            x1, y1 = ring1[i-1]
-            x2, y2 = ring1[i]
-            if (lat < y1 and lat < y2) or (lat > y1 and lat > y2):
-                continue
-            if (lat == y1 and lon == x1) or (lat == y2 and lon == x2):
-                # Consider ring touch as 'in'
-                flg = True
-                break
-            if (lat > y1 and lat <= y2) or (lat > y2 and lat <= y1):
-                if lon > x1 + (lat-y1) * (x2-x1) / (y2-y1):
-                    flg = not flg
-        if not flg:
-            # At least 1 point out
-            return False
-    return True
+    return PreparedRing(ring1).containsRing(ring2)
@@ -27,6 +27,7 @@ topology magic.
 
 import math
 import array
+from collections import deque
 precision = 9   # Compute with 9 digits but truncated for OSM to 7 digits
 import logo
 
@@ -45,6 +46,11 @@ class ShapeUtil:
         self.line_seg = array.array('i',
                           [0] * (mem/2))      # (segment id) -> line id
         self.line_ends = array.array('i')     # (line id) -> segment id
+        self.line_first = array.array('i')    # (line id) -> a segment of line
+        self.line_signif = []                 # (line id) -> point deviation
+        self.line_bbox = array.array('d')     # (line id) -> xmin, xmax, ...
+        self.line_length = array.array('d')   # (line id) -> length (meters)
+        self.line_nbpts = array.array('i')    # (line id) -> number of points
         self.segment_count = 0                # incremental segment id
         self.line_count = 0                   # incremental line id
         self.cachemem = mem                   # nb object max in memory
@@ -194,9 +200,26 @@ class ShapeUtil:
         return (pointid1, pointid2)
 
 
-    def getLineCoords(self, lineid):
+    def getLineEndSegments(self, lineid):
+        """
+        Get first and last segment of a line, each segment is oriented
+        from the end of the line to its neighbour point.
+        """
+
+        idx = (lineid-1)*2
+        segmentdir1 = self.line_ends[idx]
+        segmentdir2 = self.line_ends[idx+1]
+        return ( (self.coord_pnt[segmentdir1], self.coord_pnt[segmentdir1^1]),
+                 (self.coord_pnt[segmentdir2], self.coord_pnt[segmentdir2^1]) )
+
+
+    def getLineCoords(self, lineid, deviation=None):
         """
         Get list of all coordinates points in a line.
+
+        With a 'deviation' (in meters) only keep points which would not
+        be removed by a Douglas-Peucker with this distance (need the
+        significance computed by buildSimplifiedLines).
         """
 
         idx = (lineid-1)*2
@@ -207,9 +230,80 @@ class ShapeUtil:
             segmentdir1 = self.segment_connect[segmentdir1^1]
             coords.append(self.coord_pnt[segmentdir1])
         coords.append(self.coord_pnt[segmentdir2])
+        if deviation is not None:
+            coords = self._filterSignificance(lineid, coords, deviation)
         return coords
 
 
+    def getLineSignificance(self, lineid):
+        """
+        Get deviation (in meters) for each point in a line, the point is
+        dropped by a Douglas-Peucker using a greater distance.
+        """
+
+        assert self.line_signif, "Significance of points not computed"
+        return self.line_signif[lineid-1]
+
+
+    def _filterSignificance(self, lineid, points, deviation):
+        signif = self.getLineSignificance(lineid)
+        return [ points[i] for i in xrange(len(points))
+                 if signif[i] >= deviation ]
+
+
+    def getLineExtent(self, lineid):
+        """
+        Get bounding box of a line.
+        Return (xmin, xmax, ymin, ymax).
+        """
+
+        idx = (lineid-1)*4
+        return tuple(self.line_bbox[idx:idx+4])
+
+
+    def getExtentLines(self, lineids):
+        """
+        Get bounding box of a bunch of lines, without reading coordinates.
+        Return (xmin, xmax, ymin, ymax) or None if there is no line.
+        """
+
+        bbox = self.line_bbox
+        idx = [ (lineid-1)*4 for lineid in lineids ]
+        if not idx:
+            return None
+        return ( min([ bbox[i] for i in idx ]),
+                 max([ bbox[i+1] for i in idx ]),
+                 min([ bbox[i+2] for i in idx ]),
+                 max([ bbox[i+3] for i in idx ]) )
+
+
+    def getLineLength(self, lineid):
+        """ Return length of a line in meters. """
+        return self.line_length[lineid-1]
+
+
+    def nbrLinePoints(self, lineid):
+        """ Return number of points in a line. """
+        return self.line_nbpts[lineid-1]
+
+
+    def _addLineMetrics(self, coords):
+        """
+        Record bounding box, length and number of points of a new line.
+        """
+
+        xcoords = [ coord[0] for coord in coords ]
+        ycoords = [ coord[1] for coord in coords ]
+        self.line_bbox.extend( (min(xcoords), max(xcoords),
+                                min(ycoords), max(ycoords)) )
+        length = 0.0
+        for i in xrange(1, len(coords)):
+            length += angledistance(xcoords[i-1], ycoords[i-1],
+                                    xcoords[i], ycoords[i])[1]
+        self.line_length.append(length * 6371000.0)
+        self.line_nbpts.append(len(coords))
+
+
     def iterPoints(self):
         """
         Generator function on pointid and coordinates.
@@ -225,9 +319,16 @@ class ShapeUtil:
         return len(self.point_pos)
 
 
-    def iterLines(self):
+    def nbrPointIds(self):
+        """ Return upper bound of point ids (ids are not consecutive). """
+        return self.segment_count
+
+
+    def iterLines(self, deviation=None):
         """
         Generator function on lineid and list of pointid.
+
+        See getLineCoords() for 'deviation'.
         """
 
         for lineid in xrange(self.line_count):
@@ -238,6 +339,9 @@ class ShapeUtil:
                 segmentdir1 = self.segment_connect[segmentdir1^1]
                 pointids.append(self.point_pos[self.coord_pnt[segmentdir1]])
             pointids.append(self.point_pos[self.coord_pnt[segmentdir2]])
+            if deviation is not None:
+                pointids = self._filterSignificance(lineid+1, pointids,
+                                                    deviation)
             yield lineid+1, pointids
         return
 
@@ -247,7 +351,7 @@ class ShapeUtil:
         return self.line_count
 
 
-    def buildSimplifiedLines(self):
+    def buildSimplifiedLines(self, significance=False):
         """
         Grab each segment and build polylines (OSM way compatible).
 
@@ -255,6 +359,10 @@ class ShapeUtil:
         connection, remove useless point (simplify geometry) and make
         sure there's not too much point in a line (limit of 2000 OSM
         nodes per way).
+
+        If 'significance' is True, also record for each point the
+        deviation at which it would be simplified, a coarser level of
+        detail can then be extracted without redoing the simplification.
         """
 
         logo.DEBUG("Before simplification %d points, %d segments" % (
@@ -265,18 +373,19 @@ class ShapeUtil:
             self.line_seg = array.array('i', [0] * (self.cachemem/2))
             self.line_ends = array.array('i')
             self.line_count = 0
+        self.line_first = array.array('i')
         specialjoinset = set()
         for segmentnum in xrange(0, self.segment_count, 2):
             logo.progress(segmentnum)
             if self.line_seg[segmentnum/2]:
                 # Already attached
                 continue
-            coordpts = self._buildLineFromSegment(segmentnum)
-            if coordpts is None:
+            line = self._buildLineFromSegment(segmentnum)
+            if line is None:
                 # Orphaned segment, happens when a point is simplified
                 # and the segment is dropped
                 continue
-            self._simplifyLineSegment(coordpts, specialjoinset)
+            self._simplifyLineSegment(line[0], specialjoinset)
         logo.ending()
 
         # Special case for merged segment (duplicate segment removed)
@@ -289,65 +398,71 @@ class ShapeUtil:
             newjoinset = set()
             for lineid in specialjoinset:
                 logo.progress()
-                try:
-                    segmentnum = self.line_seg.index(lineid) * 2
-                except ValueError:
+                segmentnum = self._getLineSegment(lineid)
+                if segmentnum is None:
                     continue
-                coordpts = self._buildLineFromSegment(segmentnum, lineid)
-                self._simplifyLineSegment(coordpts, newjoinset)
+                line = self._buildLineFromSegment(segmentnum, lineid)
+                self._simplifyLineSegment(line[0], newjoinset)
             logo.ending()
             specialjoinset = newjoinset
 
         # Renumbering line id, no gap and less than 2000 nodes per line
         logo.starting("Build way with 2000 nodes limit", self.segment_count/2)
         self.line_seg = array.array('i', [0] * (self.segment_count/2))
+        self.line_first = array.array('i')
+        self.line_signif = []
+        self.line_bbox = array.array('d')
+        self.line_length = array.array('d')
+        self.line_nbpts = array.array('i')
         self.line_count = 0
         for segmentnum in xrange(0, self.segment_count, 2):
             logo.progress(segmentnum)
             if self.line_seg[segmentnum/2]:
                 # Already attached
                 continue
-            coordpts = self._buildLineFromSegment(segmentnum)
-            if coordpts is None:
+            line = self._buildLineFromSegment(segmentnum)
+            if line is None:
                 continue
 
             # Split if we are too close to the limit of 2000 nodes
             # and ensure that a new line have more than a few points
-            # we also record both extremity of a line for later use
-            segmentdir1 = self.point_pos[coordpts[0]]
-            segmentdir2 = self.point_pos[coordpts[1]]
-            segmentnum = self.getSegment(segmentdir1, segmentdir2)
-            if self.coord_pnt[segmentnum] != coordpts[0]:
-                segmentnum = segmentnum^1
-            self.line_ends.append(segmentnum)
-            while len(coordpts) > 1980:
+            # we also record both extremity of a line for later use,
+            # the chain of segments is already oriented from the first
+            # to the last point (no need to search for a segment)
+            coordpts, segchain = line
+            self.line_ends.append(segchain[0])
+            start = 0
+            while len(coordpts) - start > 1980:
                 # End of previous line and start a new one
                 self.line_count += 1
                 lineid = self.line_count
-                segmentdir1 = self.point_pos[coordpts[1949]]
-                coordpts = coordpts[1950:]
-                segmentdir2 = self.point_pos[coordpts[0]]
-                segmentnum = self.getSegment(segmentdir1, segmentdir2)
-                if self.coord_pnt[segmentnum] != coordpts[0]:
-                    segmentnum = segmentnum^1
-                self.line_ends.append(segmentnum)
-                segmentnum = self.segment_connect[segmentnum]
-                self.line_ends.append(segmentnum)
-                for i in xrange(1, min(1980, len(coordpts))):
-                    self.line_seg[int(segmentnum/2)] = lineid
-                    segmentnum = self.segment_connect[segmentnum^1]
-            segmentdir1 = self.point_pos[coordpts[-2]]
-            segmentdir2 = self.point_pos[coordpts[-1]]
-            segmentnum = self.getSegment(segmentdir1, segmentdir2)
-            if self.coord_pnt[segmentnum] != coordpts[-1]:
-                segmentnum = segmentnum^1
-            self.line_ends.append(segmentnum)
+                start += 1950
+                self.line_ends.append(segchain[start-1]^1)
+                self.line_ends.append(segchain[start])
+                self.line_first.append(segchain[start] & ~1)
+                for i in xrange(start, min(start+1979, len(segchain))):
+                    self.line_seg[int(segchain[i]/2)] = lineid
+                self._addLineMetrics(coordpts[start-1950:start+1])
+                if significance:
+                    self.line_signif.append(significancePoints(
+                                    coordpts[start-1950:start+1]))
+            self.line_ends.append(segchain[-1]^1)
+            self._addLineMetrics(coordpts[start:])
+            if significance:
+                self.line_signif.append(significancePoints(coordpts[start:]))
         logo.ending()
         logo.DEBUG("After simplification %d points, %d lines" % (
                    len(self.point_pos), self.line_count))
 
 
     def _buildLineFromSegment(self, segmentnum, lineid=0):
+        """
+        Assemble the longest line containing a segment.
+
+        Return a tuple (list of coordinates, list of segment ids oriented
+        from one coordinate to the next) or None if segment was removed.
+        """
+
         segmentdir1 = segmentnum
         segmentdir2 = segmentnum + 1
 
@@ -361,9 +476,13 @@ class ShapeUtil:
         if not lineid:
             self.line_count += 1
             lineid = self.line_count
+            self.line_first.append(segmentnum)
+        else:
+            self.line_first[lineid-1] = segmentnum
         self.line_seg[int(segmentdir1/2)] = lineid
-        coordpts = [ self.coord_pnt[segmentdir1],
-                     self.coord_pnt[segmentdir2] ]
+        coordpts = deque([ self.coord_pnt[segmentdir1],
+                           self.coord_pnt[segmentdir2] ])
+        segchain = deque([ segmentdir1 ])
 
         # Join previous segments if it's the only connection
         while nbprev == 1:
@@ -371,7 +490,8 @@ class ShapeUtil:
                 break               # loop on closed ring
             segmentdir1 = self.segment_connect[segmentdir1] ^ 1
             self.line_seg[int(segmentdir1/2)] = lineid
-            coordpts.insert(0, self.coord_pnt[segmentdir1])
+            coordpts.appendleft(self.coord_pnt[segmentdir1])
+            segchain.appendleft(segmentdir1)
             nbprev = self.nbrConnection(segmentdir1)
         else:
             # Join next segments if it's the only connection and not a loop
@@ -379,8 +499,27 @@ class ShapeUtil:
                 segmentdir2 = self.segment_connect[segmentdir2] ^ 1
                 self.line_seg[int(segmentdir2/2)] = lineid
                 coordpts.append(self.coord_pnt[segmentdir2])
+                segchain.append(segmentdir2 ^ 1)
                 nbnext = self.nbrConnection(segmentdir2)
-        return coordpts
+        return (list(coordpts), list(segchain))
+
+
+    def _getLineSegment(self, lineid):
+        """
+        Find a segment still attached to a line.
+        Return the id of the segment or None if the line has vanished.
+        """
+
+        segmentnum = self.line_first[lineid-1]
+        if self.line_seg[int(segmentnum/2)] == lineid:
+            return segmentnum
+
+        # Known segment was merged in another line, very rare so a
+        # full scan is acceptable
+        try:
+            return self.line_seg.index(lineid) * 2
+        except ValueError:
+            return None
 
 
     def _simplifyLineSegment(self, coordpts, specialjoinset):
@@ -437,6 +576,10 @@ class ShapeUtil:
                 del self.point_pos[coord]
                 self.coord_pnt[segmentdir1] = None
                 self.coord_pnt[segmentdir2] = None
+                lineid = self.line_seg[int(segmentdir2/2)]
+                if lineid and self.line_first[lineid-1] == segmentdir2 & ~1:
+                    # Segment still attached take the place of the first one
+                    self.line_first[lineid-1] = segmentnum & ~1
                 self.line_seg[int(segmentdir2/2)] = 0
 
                 # Remove segment if, with this new end, it duplicates
@@ -560,6 +703,56 @@ def simplifyPoints(points):
     return (resultpnt, deletepnt)
 
 
+def significancePoints(points):
+    """
+    Compute significance of each point in a line (ordered list of points).
+
+    Return the deviation (in meters) at which a Douglas-Peucker would
+    remove each point, it never exceeds the deviation of the point
+    splitting the line before, so any distance gives a consistent line.
+    Both ends of the line are never removed (infinite deviation), for a
+    closed line the farthest point is also kept.
+    """
+
+    infinite = float('inf')
+    signif = array.array('d', [0.0] * len(points))
+    signif[0] = infinite
+    signif[-1] = infinite
+    if points[0] == points[-1]:
+        stack = [ (0, len(points)-1, infinite, True) ]
+    else:
+        stack = [ (0, len(points)-1, infinite, False) ]
+    while stack:
+        pnt1, pnt2, devmax, keep = stack.pop()
+        if pnt2 - pnt1 < 2:
+            continue
+
+        # Most significant point between pnt1 and pnt2
+        angle_0, dist_0 = angledistance(points[pnt1][0], points[pnt1][1],
+                                        points[pnt2][0], points[pnt2][1])
+        pntfound = pnt1+1
+        devfound = -1.0
+        for pt in xrange(pnt1+1, pnt2):
+            angle_1, dist_1 = angledistance(points[pnt1][0], points[pnt1][1],
+                                            points[pt][0], points[pt][1])
+            angle_2, dist_2 = angledistance(points[pt][0], points[pt][1],
+                                            points[pnt2][0], points[pnt2][1])
+            deviation = getdeviation(diffheading(angle_0, angle_1),
+                                     dist_0, dist_1, dist_2)
+            if deviation > devfound:
+                pntfound = pt
+                devfound = deviation
+
+        if keep:
+            devfound = infinite
+        devfound = min(devfound, devmax)
+        signif[pntfound] = devfound
+        stack.append( (pnt1, pntfound, devfound, False) )
+        stack.append( (pntfound, pnt2, devfound, False) )
+
+    return signif
+
+
 def simplifyShapeZV(points, ptsdeleted):
     """
     Simplify some very big angles in line.